@@ -0,0 +1,481 @@
+# bench.py - offline benchmark for test.py against a local mock SHEIN API and a fake Telegram bot
+#
+#   python bench.py                                   # default scenarios
+#   python bench.py --products 5000 --pins 20 --drop 500 --latency 0.02 --error-rate 0.01
+#   python bench.py --compare                         # show stored runs side by side
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.py")
+BENCH_RESULTS_FILE = "bench_results.jsonl" # one JSON line per run, appended
+SCENARIOS = ["catalog_cold", "catalog_warm", "n_command", "drop", "variants"]
+
+# Mock upstream defaults (all overridable from the command line)
+DEFAULT_PRODUCTS = 5000 # catalog size
+DEFAULT_PINS = 20 # pin codes on the monitored watch
+DEFAULT_DROP = 500 # products added at once in the drop scenario
+DEFAULT_LATENCY = 0.02 # seconds per mock API response (randomised +/- 50%)
+DEFAULT_ERROR_RATE = 0.0 # fraction of mock API responses that are HTTP 500
+DEFAULT_DELIVERABLE = 0.7 # fraction of (product, pin) pairs that are serviceable
+DEFAULT_TELEGRAM_LATENCY = 0.01 # seconds per fake Telegram API call
+DEFAULT_DELIVERY_RATE = 1000 # delivery calls/sec allowed by the bot's limiter during the run
+DEFAULT_DETAIL_RATE = 1000 # product detail calls/sec allowed by the bot's limiter during the run
+MOCK_SIZES = ('S', 'M', 'L', 'XL', 'XXL') # variants served for every mock product
+
+DROP_TIMEOUT = 600 # seconds to wait for every drop alert to reach the fake Telegram bot
+
+logger = logging.getLogger("bench")
+
+# --- MOCK SHEIN API ---
+
+def mock_product(index):
+    """Raw catalog API product dict shaped like the real SHEIN payload"""
+    code = f"BENCH{index:07d}"
+    price = 299 + index % 1700
+    return {
+        'code': code,
+        'name': f"Bench Product {index}",
+        'price': {'formattedValue': f"₹{price}"},
+        'offerPrice': {'formattedValue': f"₹{price - price // 5}"},
+        'stock': {'stockLevelStatus': 'inStock'},
+        'averageRating': round(3 + (index % 20) / 10, 1),
+        'ratingCount': index % 500,
+        'url': f"/bench-product/p/{code}",
+        'fnlColorVariantData': {'colorGroup': f"group_{('black', 'white', 'blue', 'red')[index % 4]}"},
+        'images': [{'format': 'product', 'imageType': 'PRIMARY', 'url': f"https://img.example.invalid/{code}.jpg"}],
+        'tags': {'categoryTags': [{'category': 'SELLING_POINT', 'primary': {'name': 'Bestseller'}}]},
+    }
+
+class MockShein:
+    """Minimal HTTP/1.1 server for the catalog, delivery, product detail and cookie warm-up endpoints"""
+
+    def __init__(self, products, latency, error_rate, deliverable):
+        self.products = [mock_product(i) for i in range(products)]
+        self.next_index = products
+        self.latency = latency
+        self.error_rate = error_rate
+        self.deliverable = deliverable
+        self.calls = Counter()
+        self.server = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def add_drop(self, count):
+        """Put count new products at the front of the catalog, shifting every page"""
+        new = [mock_product(self.next_index + i) for i in range(count)]
+        self.next_index += count
+        self.products[:0] = new
+        return [product['code'] for product in new]
+
+    async def handle(self, reader, writer):
+        """Serve keep-alive requests on one connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get('content-length') or 0):
+                    await reader.readexactly(int(headers['content-length']))
+
+                status, body, extra_headers = await self.route(target, headers)
+                head = [f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}",
+                        f"Content-Length: {len(body)}", "Content-Type: application/json"]
+                head.extend(f"{name}: {value}" for name, value in extra_headers.items())
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target, headers):
+        url = urlsplit(target)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/shop/shein':
+            self.calls['warmup'] += 1
+            return 200, b'<html></html>', {'Set-Cookie': f"bm_sz=bench{self.calls['warmup']}; Path=/"}
+
+        endpoint = ('delivery' if url.path.startswith('/api/edd/') else 'catalog' if url.path.startswith('/api/category/')
+                    else 'detail' if url.path.startswith('/api/p/') else None)
+        if endpoint is None:
+            return 404, b'{}', {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            self.calls[f"{endpoint}_errors"] += 1
+            return 500, b'{}', {}
+        if endpoint == 'catalog':
+            return self.catalog_page(params, headers)
+        if endpoint == 'detail':
+            return self.product_detail(url.path.rsplit('/', 1)[-1])
+        return self.delivery(params)
+
+    def catalog_page(self, params, headers):
+        page = int(params.get('currentPage', 0))
+        size = int(params.get('pageSize', 45))
+        total_pages = max(1, math.ceil(len(self.products) / size))
+        body = json.dumps({
+            'products': self.products[page * size:(page + 1) * size],
+            'pagination': {'currentPage': page, 'pageSize': size, 'totalPages': total_pages, 'totalResults': len(self.products)},
+        }).encode('utf-8')
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        if headers.get('if-none-match') == etag:
+            self.calls['catalog_not_modified'] += 1
+            return 304, b'', {'ETag': etag}
+        return 200, body, {'ETag': etag}
+
+    def product_detail(self, code):
+        # Mirrors the shape parse_product_variants expects; the real /api/p/ response has not been verified
+        options = []
+        for size in MOCK_SIZES:
+            in_stock = hashlib.blake2b(f"{code}:{size}".encode('utf-8'), digest_size=1).digest()[0] < 192
+            options.append({
+                'code': f"{code}_{size}",
+                'stock': {'stockLevelStatus': 'inStock' if in_stock else 'outOfStock'},
+                'variantOptionQualifiers': [{'qualifier': 'size', 'value': size}],
+            })
+        body = json.dumps({'code': code, 'fnlColorVariantData': {'colorGroup': 'group_black'}, 'variantOptions': options}).encode('utf-8')
+        return 200, body, {}
+
+    def delivery(self, params):
+        key = f"{params.get('productCode')}:{params.get('postalCode')}".encode('utf-8')
+        serviceable = hashlib.blake2b(key, digest_size=2).digest()[0] < 256 * self.deliverable
+        body = json.dumps({
+            'status': {'statusCode': 0},
+            'productDetails': [{
+                'servicability': serviceable,
+                'deliveryMethod': 'Standard Delivery' if serviceable else '',
+                'codEligible': serviceable,
+                'reasonForNotServiceability': '' if serviceable else 'Pincode not serviceable',
+            }],
+        }).encode('utf-8')
+        return 200, body, {}
+
+# --- FAKE TELEGRAM ---
+
+class FakeBot:
+    """Stand-in for telegram.Bot: records every send and simulates Bot API latency"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.new_product_alerts = 0
+        self.items = 0
+
+    async def _call(self, method, texts):
+        self.calls[method] += 1
+        self.items += len(texts)
+        self.new_product_alerts += sum('NEW PRODUCT ALERT' in (text or '') for text in texts)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        await self._call('send_message', [text])
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, **kwargs):
+        await self._call('send_photo', [caption])
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._call('send_media_group', [getattr(item, 'caption', None) for item in media])
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        pass
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage()
+
+class FakeUpdate:
+    def __init__(self, chat_id, user_id):
+        self.message = FakeMessage()
+        self.effective_chat = type('Chat', (), {'id': chat_id})()
+        self.effective_user = type('User', (), {'id': user_id})()
+
+class FakeContext:
+    def __init__(self, args):
+        self.args = args
+
+class FakeApplication:
+    """Just enough of telegram.ext.Application for post_init/post_shutdown"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.tasks = []
+
+    def create_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+# --- MEASUREMENT ---
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Recorder:
+    """Times every upstream call the bot makes and snapshots resource use per scenario"""
+
+    def __init__(self, bot, track_memory):
+        self.latencies = defaultdict(list)
+        self.track_memory = track_memory
+        original_http_get = bot.http_get
+
+        async def timed_http_get(url, params=None, headers=None):
+            started = time.perf_counter()
+            try:
+                return await original_http_get(url, params=params, headers=headers)
+            finally:
+                endpoint = 'delivery' if '/api/edd/' in url else 'detail' if '/api/p/' in url else 'catalog'
+                self.latencies[endpoint].append(time.perf_counter() - started)
+
+        bot.http_get = timed_http_get
+
+    def start(self, server, fake_bot):
+        self.latencies.clear()
+        self.server_calls = Counter(server.calls)
+        self.telegram_calls = Counter(fake_bot.calls)
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+
+    def finish(self, server, fake_bot, items, **extra):
+        elapsed = time.perf_counter() - self.started
+        result = {
+            'seconds': round(elapsed, 3),
+            'items': items,
+            'items_per_sec': round(items / elapsed, 1) if elapsed > 0 else 0.0,
+            'api_calls': dict(Counter(server.calls) - self.server_calls),
+            'telegram_calls': dict(Counter(fake_bot.calls) - self.telegram_calls),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        for endpoint, values in self.latencies.items():
+            result[f"{endpoint}_p50_ms"] = round(percentile(values, 0.50) * 1000, 2)
+            result[f"{endpoint}_p99_ms"] = round(percentile(values, 0.99) * 1000, 2)
+        if self.track_memory:
+            result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        result.update(extra)
+        return result
+
+# --- SCENARIOS ---
+
+def load_bot(server, args):
+    """Import test.py as a module and point it at the mock API"""
+    pins = [f"{500001 + i}" for i in range(args.pins)]
+    with open("watches.json", "w") as f:
+        json.dump([{'name': 'bench', 'category': 'bench-category', 'query': ':relevance', 'facets': '',
+                    'pin_codes': pins, 'chat_id': '-100', 'interval': 2}], f)
+
+    spec = importlib.util.spec_from_file_location("bot", BOT_SCRIPT)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+
+    bot.CATALOG_API_BASE_URL = server.base_url + "/api/category/"
+    bot.DELIVERY_API_URL = server.base_url + "/api/edd/checkDeliveryDetails"
+    bot.PRODUCT_DETAIL_API_URL = server.base_url + "/api/p/"
+    bot.COOKIE_WARMUP_URL = server.base_url + "/shop/shein"
+    bot.CHAT_ID = '-100'
+    bot.METRICS_PORT = None
+    # The fake bot has no rate limits and the timing should not include the coalescing window
+    bot.ALERT_COALESCE_WINDOW = 0
+    bot.NOTIFY_GLOBAL_RATE = bot.NOTIFY_CHAT_RATE = bot.NOTIFY_GROUP_RATE = 10000
+    bot.NOTIFY_GLOBAL_BURST = bot.NOTIFY_CHAT_BURST = bot.NOTIFY_GROUP_BURST = 10000
+    bot.DELIVERY_LIMITER = bot.AdaptiveRateLimiter(args.delivery_rate, args.delivery_rate, args.delivery_rate, 1)
+    return bot, pins
+
+async def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark scenario timed out")
+        await asyncio.sleep(0.01)
+
+async def run_benchmarks(args):
+    server = MockShein(args.products, args.latency, args.error_rate, args.deliverable)
+    await server.start()
+    bot, pins = load_bot(server, args)
+    fake_bot = FakeBot(args.telegram_latency)
+    application = FakeApplication(fake_bot)
+    recorder = Recorder(bot, args.memory)
+    watch = bot.DEFAULT_WATCH
+    results = {}
+
+    try:
+        if 'catalog_cold' in args.scenarios:
+            recorder.start(server, fake_bot)
+            catalog = await bot.fetch_catalog(watch)
+            results['catalog_cold'] = recorder.finish(server, fake_bot, len(catalog['products']) if catalog else 0)
+
+        if 'catalog_warm' in args.scenarios:
+            await bot.fetch_catalog(watch)  # make sure every page is cached
+            recorder.start(server, fake_bot)
+            catalog = await bot.fetch_catalog(watch)
+            results['catalog_warm'] = recorder.finish(server, fake_bot, len(catalog['products']) if catalog else 0)
+
+        # Seeds the state database and starts the dispatcher, scheduler and monitor
+        await bot.post_init(application)
+        await wait_for(lambda: bot.MONITOR_STATS['passes'] >= 1, DROP_TIMEOUT)
+
+        if 'n_command' in args.scenarios:
+            bot.DELIVERY_CACHE.clear()
+            sent_before = fake_bot.items
+            recorder.start(server, fake_bot)
+            await bot.deliverable_products_command(FakeUpdate(-100, 1), FakeContext([pins[0]]))
+            checked_at = time.perf_counter() - recorder.started
+            deliverable = len(bot.RESULT_SESSIONS.get(-100, 1).products)
+            await wait_for(lambda: fake_bot.items - sent_before >= deliverable + 1, DROP_TIMEOUT)
+            results['n_command'] = recorder.finish(server, fake_bot, args.products,
+                                                   deliverable=deliverable, checks_done_seconds=round(checked_at, 3))
+
+        if 'drop' in args.scenarios:
+            bot.DELIVERY_CACHE.clear()
+            alerts_before = fake_bot.new_product_alerts
+            passes_before = bot.MONITOR_STATS['passes']
+            recorder.start(server, fake_bot)
+            server.add_drop(args.drop)
+            await wait_for(lambda: bot.MONITOR_STATS['passes'] > passes_before, DROP_TIMEOUT)
+            detected_at = time.perf_counter() - recorder.started
+            await wait_for(lambda: fake_bot.new_product_alerts - alerts_before >= args.drop, DROP_TIMEOUT)
+            results['drop'] = recorder.finish(server, fake_bot, args.drop, detected_seconds=round(detected_at, 3),
+                                              delivery_checks=args.drop * len(pins))
+
+        if 'variants' in args.scenarios:
+            # Resolve every listed product's sizes, as the periodic refresh does once tracking is on
+            bot.VARIANT_TRACKING = True
+            bot.VARIANT_LIMITER = bot.TokenBucket(args.detail_rate, args.detail_rate)
+            target = len(bot.VARIANT_TRACKER.listed)
+            recorder.start(server, fake_bot)
+            bot.VARIANT_TRACKER.submit_stale()
+            await wait_for(lambda: len(bot.VARIANT_TRACKER.sizes) >= target, DROP_TIMEOUT)
+            results['variants'] = recorder.finish(server, fake_bot, target, workers=bot.VARIANT_WORKERS)
+    finally:
+        for task in application.tasks:
+            task.cancel()
+        await asyncio.gather(*application.tasks, return_exceptions=True)
+        await bot.post_shutdown(application)
+        await server.stop()
+    return results
+
+# --- RESULTS ---
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(BOT_SCRIPT), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_results(results):
+    for scenario, result in results.items():
+        print(f"\n{scenario}")
+        for key, value in result.items():
+            print(f"  {key:<22} {value}")
+
+def compare_runs(path, count):
+    """Print items/sec and p99 latencies of the last runs side by side"""
+    if not os.path.exists(path):
+        print(f"No stored runs in {path}")
+        return
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()][-count:]
+    for scenario in SCENARIOS:
+        rows = [(run, run['results'][scenario]) for run in runs if scenario in run['results']]
+        if not rows:
+            continue
+        print(f"\n{scenario}")
+        for run, result in rows:
+            p99 = ', '.join(f"{key[:-7]} p99 {value}ms" for key, value in result.items() if key.endswith('_p99_ms'))
+            print(f"  {run['started_at'][:19]}  {run.get('revision') or '-':<9} {result['items_per_sec']:>10}/s  "
+                  f"{result['seconds']:>8}s  {p99}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark test.py against a local mock SHEIN API")
+    parser.add_argument('--products', type=int, default=DEFAULT_PRODUCTS)
+    parser.add_argument('--pins', type=int, default=DEFAULT_PINS)
+    parser.add_argument('--drop', type=int, default=DEFAULT_DROP)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY)
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_ERROR_RATE)
+    parser.add_argument('--deliverable', type=float, default=DEFAULT_DELIVERABLE)
+    parser.add_argument('--telegram-latency', type=float, default=DEFAULT_TELEGRAM_LATENCY)
+    parser.add_argument('--delivery-rate', type=float, default=DEFAULT_DELIVERY_RATE)
+    parser.add_argument('--detail-rate', type=float, default=DEFAULT_DETAIL_RATE)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma separated subset of {SCENARIOS}")
+    parser.add_argument('--memory', action='store_true', help="track Python allocations (slower)")
+    parser.add_argument('--results', default=BENCH_RESULTS_FILE)
+    parser.add_argument('--label', default='', help="free text stored with the run")
+    parser.add_argument('--compare', type=int, nargs='?', const=10, metavar='N', help="show the last N stored runs and exit")
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    results_path = os.path.abspath(args.results)
+
+    if args.compare:
+        compare_runs(results_path, args.compare)
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    if args.memory:
+        tracemalloc.start()
+
+    started_at = datetime.now().isoformat()
+    workdir = os.getcwd()
+    # The bot keeps its state database, cookies.txt and watches.json in the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            results = asyncio.run(run_benchmarks(args))
+        finally:
+            os.chdir(workdir)
+
+    print_results(results)
+    run = {
+        'started_at': started_at,
+        'revision': git_revision(),
+        'label': args.label,
+        'python': sys.version.split()[0],
+        'params': {name: value for name, value in vars(args).items() if name not in ('results', 'compare', 'label')},
+        'results': results,
+    }
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"\nStored in {results_path}")
+
+if __name__ == '__main__':
+    main()
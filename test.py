@@ -1,16 +1,46 @@
 import logging
-import requests
+import httpx
 import json
 import os
 import time
 import asyncio
+import bisect
+import hashlib
+import html
+import heapq
+import random
 import re
-from datetime import datetime
+import sqlite3
+from array import array
+import http.cookiejar as cookiejar
+from collections import OrderedDict, namedtuple
 from concurrent.futures import ThreadPoolExecutor
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from typing import List, Optional, TypedDict
+from datetime import datetime
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from bs4 import BeautifulSoup
 
+try:
+    import h2  # noqa: F401 - enables HTTP/2 support in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Optional fast JSON libraries, stdlib json is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -24,7 +54,10 @@ BOT_TOKEN = "8482314639:AAGqtergUDCwWWlEbDHUboikWOpbVn5Ab2c"
 # Updated CHAT_ID for the group -1003028949899
 CHAT_ID = "-1003237492963" # Target Group/Channel for real-time updates
 
-# Files to store data
+# SQLite database holding all monitor state
+STATE_DB_FILE = "shein_state.db"
+
+# Legacy flat files, migrated into STATE_DB_FILE on first start
 PRODUCT_CODES_FILE = "product_codes.txt"
 PRODUCT_DETAILS_FILE = "product_details.json"
 OUT_OF_STOCK_FILE = "out_of_stock.txt"
@@ -33,13 +66,150 @@ NOTIFIED_NEW_PRODUCTS_FILE = "notified_new_products.txt"
 NOTIFIED_PRICE_CHANGES_FILE = "notified_price_changes.json"
 
 # SHEIN API endpoints
-CATALOG_API_URL = "https://www.sheinindia.in/api/category/sverse-5939-37961"
+CATALOG_API_BASE_URL = "https://www.sheinindia.in/api/category/" # + the watch's category id
 DELIVERY_API_URL = "https://www.sheinindia.in/api/edd/checkDeliveryDetails"
+# Unverified: the detail endpoint path and its variantOptions response shape are inferred, not taken from a
+# captured response; parse_product_variants treats anything else as "no variants" (bench.py's mock uses the same guess)
+PRODUCT_DETAIL_API_URL = "https://www.sheinindia.in/api/p/" # + product code, lists the size/color variants
+
+# Catalog crawling
+CATALOG_PAGE_SIZE = 45 # Products per catalog page
+CATALOG_CONCURRENCY = 8 # Catalog pages fetched at once after the first page
+CATALOG_MAX_PAGES = 500 # Safety cap on pages crawled per sweep
+
+# Upstream resilience
+CATALOG_MAX_RETRIES = 3 # retries per catalog page before giving up on the sweep
+CATALOG_RETRY_MAX_DELAY = 8 # seconds, cap for the exponential retry backoff
+BREAKER_FAILURE_THRESHOLD = 5 # consecutive failures that open a circuit breaker
+BREAKER_RESET_TIMEOUT = 60 # seconds an open breaker fails fast before letting a trial call through
+
+# Watch scheduling
+WATCHES_FILE = "watches.json" # optional list of watch definitions, replaces WATCHES below when present
+WATCH_CONCURRENCY = 4 # watches swept at once by the shared scheduler
+WATCH_RETRY_DELAY = 30 # seconds before the first retry of a watch whose sweep failed, doubled per failure
+
+# Adaptive polling (a watch's 'interval' is where it starts)
+WATCH_MIN_INTERVAL = 2 # seconds, floor while changes keep coming in (drop windows)
+WATCH_QUIET_MAX_INTERVAL = 30 # seconds, ceiling reached by backing off during quiet periods
+WATCH_MAX_INTERVAL = 300 # seconds, ceiling reached by backing off after upstream errors
+WATCH_BACKOFF_FACTOR = 1.5 # interval multiplier after a quiet sweep
+WATCH_CHANGE_SMOOTHING = 0.2 # weight of the latest sweep in the smoothed change rate
+WATCH_JITTER = 0.2 # +/- fraction of randomness added to every interval
+
+# Shared catalog snapshot
+CATALOG_SNAPSHOT_MAX_AGE = 15 # seconds commands reuse the monitor's last sweep before refreshing it
+
+# Event loop health
+BLOCKING_WORKERS = 4 # threads for CPU-heavy work (JSON decoding, diffing)
+LOOP_WATCHDOG_INTERVAL = 0.5 # seconds between event loop heartbeats
+LOOP_STALL_THRESHOLD = 0.25 # seconds of heartbeat lag that gets logged as a stall
+
+# Cookie session (cookies.txt is the MozillaCookieJar file written by c.py)
+COOKIES_FILE = "cookies.txt" # loaded at start, rewritten after every refresh; COOKIES below is the fallback
+COOKIE_DOMAIN = ".sheinindia.in" # domain given to the fallback COOKIES
+COOKIE_WARMUP_URL = "https://www.sheinindia.in/shop/shein" # page c.py visits to obtain fresh cookies
+COOKIE_REFRESH_INTERVAL = 20 * 60 # seconds between background refreshes
+COOKIE_REFRESH_MARGIN = 5 * 60 # seconds before the earliest cookie expiry to refresh
+COOKIE_REFRESH_MIN_GAP = 30 # seconds, 403s this soon after a refresh do not trigger another one
+
+# Metrics endpoint (Prometheus text format)
+METRICS_HOST = "127.0.0.1" # only reachable from this machine by default
+METRICS_PORT = 9464 # serve /metrics here, None disables the endpoint
+
+# Shared HTTP client
+HTTP_TIMEOUT = 10 # seconds
+HTTP_MAX_CONNECTIONS = 100 # Total pooled connections across all hosts
+HTTP_MAX_CONNECTIONS_PER_HOST = 20 # Concurrent requests allowed per host
+HTTP_KEEPALIVE_EXPIRY = 30 # seconds an idle pooled connection is kept open
+
+# Delivery serviceability cache
+DELIVERY_CACHE_TTL = 300 # seconds a successful (productCode, postalCode) lookup is reused
+DELIVERY_CACHE_NEGATIVE_TTL = 30 # seconds a failed lookup is reused before retrying upstream
+DELIVERY_CACHE_MAX_SIZE = 50000 # Least recently used entries are evicted past this size
+
+# Delivery check scheduling
+DELIVERY_MAX_CONCURRENCY = 16 # delivery API calls in flight at once, across all commands and the monitor
+DELIVERY_INITIAL_RATE = 10 # delivery API calls per second to start with
+DELIVERY_MIN_RATE = 0.5 # never slow down below this rate
+DELIVERY_MAX_RATE = 40 # never speed up beyond this rate
+DELIVERY_THROTTLE_COOLDOWN = 5 # seconds to pause all delivery calls after a 429/403
+
+# Notification dispatcher (Telegram allows ~30 msg/s overall, ~1 msg/s per chat, 20 msg/min per group)
+NOTIFY_GLOBAL_RATE = 25 # messages per second across all chats
+NOTIFY_GLOBAL_BURST = 25
+NOTIFY_CHAT_RATE = 1 # messages per second to a private chat
+NOTIFY_CHAT_BURST = 3
+NOTIFY_GROUP_RATE = 20 / 60 # messages per second to a group/channel
+NOTIFY_GROUP_BURST = 3
+NOTIFY_BATCH_SIZE = 200 # outbox rows a chat's sender loads to build its next batch
+NOTIFY_MAX_ATTEMPTS = 8 # give up on a message after this many failed sends
+NOTIFY_RETRY_BASE_DELAY = 2 # seconds, doubled after every failed send
+NOTIFY_RETRY_MAX_DELAY = 300 # seconds
+
+# Alert coalescing
+ALERT_COALESCE_WINDOW = 10 # seconds monitor alerts are collected before being sent together
+MEDIA_GROUP_LIMIT = 10 # photos per send_media_group album (Telegram maximum)
+TELEGRAM_MESSAGE_LIMIT = 4096 # characters per text message (Telegram maximum)
+
+# Command result sessions (what /checkdelivery <number> refers to)
+RESULT_SESSION_TTL = 6 * 3600 # seconds a /n or /products result list stays addressable
+RESULT_SESSION_MAX = 500 # least recently used sessions are evicted past this count
+
+# Price history and trend alerts
+PRICE_HISTORY_RETENTION_DAYS = 365 # points older than this are dropped (all-time low/high are kept)
+PRICE_HISTORY_COMPACT_AFTER_DAYS = 7 # points older than this are reduced to the lowest one per day
+PRICE_HISTORY_COMPACT_AT = 64 # a series is compacted whenever it grows past this many points
+PRICE_ALERT_MIN_CHANGE_PCT = 0 # alert on effective price changes of at least this many percent (0 = every change)
+PRICE_ALERT_DROPS_ONLY = False # True: only alert when the price goes down
+PRICE_ALERT_BIG_DROP_PCT = 20 # drops of at least this many percent are highlighted
+PRICE_LOW_WINDOW_DAYS = 30 # window for the "lowest in N days" figure shown by /checkdelivery
+
+# Variant (size/color) availability from product detail lookups
+VARIANT_TRACKING = False # True: resolve variants for every watch's products, not only watches that set 'sizes'
+VARIANT_WORKERS = 8 # detail lookups in flight at once
+VARIANT_RATE = 15 # detail lookups per second across all workers
+VARIANT_CACHE_TTL = 600 # seconds a product's resolved variants are reused
+VARIANT_CACHE_NEGATIVE_TTL = 60 # seconds a failed lookup is reused before retrying upstream
+VARIANT_CACHE_MAX_SIZE = 20000 # Least recently used products are evicted past this size
+VARIANT_REFRESH_INTERVAL = 1800 # seconds before an unchanged tracked product is looked up again
+VARIANT_QUEUE_MAX = 20000 # queued lookups; past this, periodic refreshes are skipped until the queue drains
+
+# Stock tracking
+STOCK_CONFIRM_SWEEPS = 3 # further sweeps of its watches a missing product must stay missing before it counts as out of stock
+STOCK_OUT_RETENTION_DAYS = 90 # days a delisted product is remembered after going out of stock; a later comeback alerts as new
+
+# Notification dedup ledger
+NOTIFIED_TTLS = {'new_product': 30 * 86400, 'out_of_stock': 6 * 3600, 'restock': 6 * 3600, 'price_change': 3 * 86400} # seconds an alert suppresses repeats, per kind
+NOTIFIED_MAX_ENTRIES = 200000 # newest ledger entries kept per kind, older ones are dropped by compaction
+LEDGER_COMPACT_INTERVAL = 3600 # seconds between background ledger compactions (delisted products are pruned on the same schedule)
+LEDGER_FILTER_BITS = 8 * 1024 * 1024 # Bloom filter size (1 MiB), ~1% false positives with every kind at NOTIFIED_MAX_ENTRIES
+LEDGER_FILTER_HASHES = 7 # bit positions set per key
+
+# Message rendering
+PRODUCT_CARD_CACHE_SIZE = 20000 # product versions whose static message parts are kept pre-rendered
+
+# Command progress messages
+PROGRESS_EDIT_INTERVAL = 3 # seconds between progress message edits
 
 # Default Pin codes for background monitoring and /n when no pin is specified
 DEFAULT_PIN_CODE_N = "504231" # Default for /n command
 MONITOR_PIN_CODES = ["504231"] # Used for background alerts
 
+# Catalog listings to monitor. The first one also backs /n and /products.
+# pin_codes and chat_id default to MONITOR_PIN_CODES and CHAT_ID; interval is in seconds.
+# Optional 'sizes' (e.g. ['M', 'L']) tracks the watch's variants and alerts when those sizes come back.
+WATCHES = [
+    {
+        'name': 'men',
+        'category': 'sverse-5939-37961',
+        'query': ':relevance:genderfilter:Men',
+        'facets': 'genderfilter:Men',
+        'pin_codes': MONITOR_PIN_CODES,
+        'chat_id': CHAT_ID,
+        'interval': 5,
+    },
+]
+
 # Headers and Cookies (keeping them as provided)
 HEADERS = {
     'accept': 'application/json',
@@ -48,476 +218,2959 @@ HEADERS = {
     'x-tenant-id': 'SHEIN'
 }
 
-COOKIES = {
-    "V": "1",
-    "_abck": "60A3EA44D6452E391F47D20DED1FE802~-1~YAAQ2W8nF+tpMS+aAQAADUH3QA64OTc8xz7NHwZ0GS7QI2ORkCs503JGsao/mUXDYUkWccjzt0kNFHJXwJbgdYaSPBdyp94eHG02V8KPGi+jtQozik03WhmecvQK9KCI14NJDtA2W+aWFRsHzRY1MafwFoEWnVBzQI5I2lJFliraP3c/7aLl8NpP8g94G/sDZMerju2+lmDSxRb8IugFsRIPzoAdTsHzaPlYRqe8R5zQFE0LZzkvoJXsbQTwzy8O2VZ7N3cbk3AJuIo30CsxcIbQucvXULZZMSwj3SLh3kvlMbzfnHyTdCgoyfomS2KzhkFmjBEyu/z3gsVwAwU9GKvfVIvQrmkXs2uY6ATLlhzqkSi90riguLd+uwJ0IBmQLlhPXM/uAQZRQiebZXwSur1TFWiDc0zRf8zVhDjIv2oBavNN6BCEyM8Tmonh4D+6RHaS/GAGj38=~-1~-1~-1~-1~-1",
-    "bm_sz": "AAE0BB48D9D9A1E8D27EC3997A2E51D5~YAAQ2W8nF+xpMS+aAQAADUH3QB3te1dbaBY7zrBgwg4XJo6gCuqVEJ4fYsW6l8XqAKcbEqEjagpdWdZZwreP46IC1gT4WwGkslJubaOFBfkyHDQov71kJDHQntaS3mSH2XoAD4b4KIZbMCgaw3IcXZFmfywIIeJK6SPPUsM1fFk0fNoch9ZwdOjHUsXdtyy3RSfg3aojY/pbj/EYh/9WT9KCAT4BzmAkvThWn50yEWIEMcXPHBKOC4YRdOJ2MggfQdDRw18PaeL0LYMZFBND63SNamrBqx0YkLwtXBpSrJ24yixsDYkRptiGbOZVz9834jtUtJcznnTUpysP2+qbt7bgq5CsBIooElwapS8ih8eT~4405554~4469554"
-}
+COOKIES = {
+    "V": "1",
+    "_abck": "60A3EA44D6452E391F47D20DED1FE802~-1~YAAQ2W8nF+tpMS+aAQAADUH3QA64OTc8xz7NHwZ0GS7QI2ORkCs503JGsao/mUXDYUkWccjzt0kNFHJXwJbgdYaSPBdyp94eHG02V8KPGi+jtQozik03WhmecvQK9KCI14NJDtA2W+aWFRsHzRY1MafwFoEWnVBzQI5I2lJFliraP3c/7aLl8NpP8g94G/sDZMerju2+lmDSxRb8IugFsRIPzoAdTsHzaPlYRqe8R5zQFE0LZzkvoJXsbQTwzy8O2VZ7N3cbk3AJuIo30CsxcIbQucvXULZZMSwj3SLh3kvlMbzfnHyTdCgoyfomS2KzhkFmjBEyu/z3gsVwAwU9GKvfVIvQrmkXs2uY6ATLlhzqkSi90riguLd+uwJ0IBmQLlhPXM/uAQZRQiebZXwSur1TFWiDc0zRf8zVhDjIv2oBavNN6BCEyM8Tmonh4D+6RHaS/GAGj38=~-1~-1~-1~-1~-1",
+    "bm_sz": "AAE0BB48D9D9A1E8D27EC3997A2E51D5~YAAQ2W8nF+xpMS+aAQAADUH3QB3te1dbaBY7zrBgwg4XJo6gCuqVEJ4fYsW6l8XqAKcbEqEjagpdWdZZwreP46IC1gT4WwGkslJubaOFBfkyHDQov71kJDHQntaS3mSH2XoAD4b4KIZbMCgaw3IcXZFmfywIIeJK6SPPUsM1fFk0fNoch9ZwdOjHUsXdtyy3RSfg3aojY/pbj/EYh/9WT9KCAT4BzmAkvThWn50yEWIEMcXPHBKOC4YRdOJ2MggfQdDRw18PaeL0LYMZFBND63SNamrBqx0YkLwtXBpSrJ24yixsDYkRptiGbOZVz9834jtUtJcznnTUpysP2+qbt7bgq5CsBIooElwapS8ih8eT~4405554~4469554"
+}
+
+
+# Global variables to store data
+PREVIOUS_CATALOG = {}
+
+# Conditional catalog fetching: last response per page and last merged sweep
+CATALOG_PAGE_CACHE = {}  # (watch name, page) -> {'etag', 'last_modified', 'digest', 'products', 'pagination'}
+LAST_CATALOG_SWEEP = {}  # watch name -> {'digest', 'catalog'}
+CATALOG_STATS = {'not_modified': 0, 'unchanged_pages': 0, 'decoded_pages': 0}
+MONITOR_STATS = {'ticks': 0, 'skipped_ticks': 0, 'passes': 0}
+
+# State database connection (opened lazily on first use)
+STATE_DB = None
+
+# Shared async HTTP client (created lazily inside the bot's event loop)
+HTTP_CLIENT = None
+HOST_SEMAPHORES = {}
+
+# --- BLOCKING WORK ---
+
+# All SQLite access happens on one dedicated thread, so the connection is never shared concurrently
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-db')
+# CPU-heavy work (decoding catalog pages, diffing sweeps) runs here instead of on the event loop
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+
+async def run_db(func, *args, **kwargs):
+    """Run a state database function on the database thread"""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, partial(func, *args, **kwargs))
+
+async def run_blocking(func, *args, **kwargs):
+    """Run CPU-heavy work on the blocking thread pool"""
+    return await asyncio.get_running_loop().run_in_executor(BLOCKING_EXECUTOR, partial(func, *args, **kwargs))
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures, then lets one trial call through per reset timeout"""
+    
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+    
+    def retry_in(self):
+        """Seconds until an open breaker lets a trial call through"""
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+    
+    def allow(self):
+        """True if a call may go upstream now"""
+        state = self.state
+        if state == 'open':
+            self.rejected += 1
+            return False
+        if state == 'half-open':
+            # Let this one call through; until it reports back the breaker stays open
+            self.opened_at = time.monotonic()
+        return True
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"{self.name} circuit breaker closed, upstream recovered")
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(f"{self.name} circuit breaker opened after {self.failures} failures, failing fast for {self.reset_timeout} seconds")
+            self.opened_at = time.monotonic()
+
+CATALOG_BREAKER = CircuitBreaker('Catalog API', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+DELIVERY_BREAKER = CircuitBreaker('Delivery API', BREAKER_FAILURE_THRESHOLD * 4, BREAKER_RESET_TIMEOUT)
+
+LOOP_STATS = {'stalls': 0, 'max_lag': 0.0}
+
+async def watch_event_loop():
+    """Log whenever the event loop was blocked for longer than LOOP_STALL_THRESHOLD"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_WATCHDOG_INTERVAL
+        await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+        lag = loop.time() - expected
+        if lag > LOOP_STALL_THRESHOLD:
+            LOOP_STATS['stalls'] += 1
+            LOOP_STATS['max_lag'] = max(LOOP_STATS['max_lag'], lag)
+            logger.warning(f"Event loop stalled for {lag:.2f} seconds")
+
+# --- METRICS ---
+
+# Latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = []  # every metric, in /metrics output order
+
+class Metric:
+    """Base for counters and gauges: a value per label value, or a callback read at scrape time"""
+    kind = 'untyped'
+    
+    def __init__(self, name, help_text, label=None, func=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.func = func  # returns a number, or a {label value: number} dict
+        self.values = {}
+        METRICS.append(self)
+    
+    def get(self, label_value=None):
+        return self.values.get(label_value, 0)
+    
+    def samples(self):
+        values = self.values
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {None: values}
+        for label_value, value in values.items():
+            labels = f'{{{self.label}="{label_value}"}}' if self.label and label_value is not None else ''
+            yield f"{self.name}{labels} {value}"
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+    
+    def inc(self, amount=1, label_value=None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+    kind = 'gauge'
+    
+    def set(self, value, label_value=None):
+        self.values[label_value] = value
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is a bisect and two additions"""
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        METRICS.append(self)
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None when empty, inf past the last bucket)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+    
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        yield f"{self.name}_sum {self.sum}"
+        yield f"{self.name}_count {self.count}"
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+CATALOG_FETCH_SECONDS = Histogram('shein_catalog_fetch_seconds', 'Catalog page request latency')
+DELIVERY_CHECK_SECONDS = Histogram('shein_delivery_check_seconds', 'Delivery API request latency')
+DETAIL_FETCH_SECONDS = Histogram('shein_detail_fetch_seconds', 'Product detail API request latency')
+CATALOG_RETRIES = Counter('shein_catalog_retries_total', 'Catalog page requests retried after a failure')
+UPSTREAM_403 = Counter('shein_upstream_403_total', 'HTTP 403 responses from SHEIN', label='api')
+ALERTS_SENT = Counter('shein_notifications_sent_total', 'Outbox messages delivered to Telegram', label='kind')
+ALERTS_FAILED = Counter('shein_notifications_failed_total', 'Outbox messages dropped after failing')
+MONITOR_PASS_SECONDS = Gauge('shein_monitor_pass_seconds', 'Duration of the last monitor diff/persist/alert pass')
+NOTIFICATION_QUEUE_DEPTH = Gauge('shein_notification_queue_depth', 'Messages waiting in the outbox')
+N_COMMAND_RATE = Gauge('shein_n_command_products_per_second', 'Products checked per second by the last /n')
+Counter('shein_delivery_cache_lookups_total', 'Delivery cache lookups by outcome', label='result',
+        func=lambda: {'hit': DELIVERY_CACHE.hits, 'coalesced': DELIVERY_CACHE.coalesced, 'miss': DELIVERY_CACHE.misses})
+Counter('shein_catalog_pages_total', 'Catalog page responses by outcome', label='result',
+        func=lambda: {'not_modified': CATALOG_STATS['not_modified'], 'unchanged': CATALOG_STATS['unchanged_pages'],
+                      'decoded': CATALOG_STATS['decoded_pages']})
+Counter('shein_watch_sweeps_total', 'Watch sweeps by outcome', label='result',
+        func=lambda: {'changed': MONITOR_STATS['ticks'] - MONITOR_STATS['skipped_ticks'], 'unchanged': MONITOR_STATS['skipped_ticks']})
+Counter('shein_event_loop_stalls_total', 'Event loop stalls over LOOP_STALL_THRESHOLD', func=lambda: LOOP_STATS['stalls'])
+Gauge('shein_delivery_rate_limit', 'Current delivery API calls/sec allowed by the AIMD limiter', func=lambda: DELIVERY_LIMITER.rate)
+Gauge('shein_circuit_breaker_open', '1 while a circuit breaker is failing fast', label='api',
+      func=lambda: {'catalog': int(CATALOG_BREAKER.state == 'open'), 'delivery': int(DELIVERY_BREAKER.state == 'open'),
+                    'detail': int(DETAIL_BREAKER.state == 'open')})
+Counter('shein_ledger_lookups_total', 'Notification ledger membership checks by outcome', label='result',
+        func=lambda: {'filtered': NOTIFICATION_LEDGER.stats['filtered'], 'false_positive': NOTIFICATION_LEDGER.stats['false_positives'],
+                      'confirmed': NOTIFICATION_LEDGER.stats['lookups'] - NOTIFICATION_LEDGER.stats['filtered'] - NOTIFICATION_LEDGER.stats['false_positives']})
+Counter('shein_variant_lookups_total', 'Product variant lookups by outcome', label='result',
+        func=lambda: {'ok': VARIANT_TRACKER.stats['lookups'] - VARIANT_TRACKER.stats['failed'], 'failed': VARIANT_TRACKER.stats['failed']})
+Gauge('shein_variant_queue_depth', 'Product variant lookups waiting for a worker', func=lambda: len(VARIANT_TRACKER.queued))
+Gauge('shein_watch_poll_interval_seconds', 'Current adaptive polling interval', label='watch',
+      func=lambda: {name: pacer.interval for name, pacer in WATCH_SCHEDULER.pacers.items()})
+
+async def handle_metrics_request(reader, writer):
+    """Answer one HTTP request on the metrics port with the current metrics"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass  # Headers are not needed
+        if request_line.split(b' ')[1:2] in ([b'/metrics'], [b'/']):
+            NOTIFICATION_QUEUE_DEPTH.set(await run_db(count_outbox))
+            status, body = '200 OK', render_metrics().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+METRICS_SERVER = None
+
+async def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT"""
+    global METRICS_SERVER
+    if METRICS_PORT is None:
+        return
+    try:
+        METRICS_SERVER = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint on port {METRICS_PORT}: {e}")
+
+def format_latency(histogram):
+    """p50/p99 of a latency histogram for /status"""
+    if not histogram.count:
+        return "no data"
+    def bound(q):
+        value = histogram.quantile(q)
+        return f">{histogram.buckets[-1]}s" if value == float('inf') else f"≤{value}s"
+    return f"p50 {bound(0.5)}, p99 {bound(0.99)} ({histogram.count} calls)"
+
+# --- JSON CODEC ---
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+    
+    def json_loads(data):
+        """Decode JSON from str or bytes"""
+        return orjson.loads(data)
+    
+    def json_dumps(obj):
+        """Encode JSON compactly"""
+        return orjson.dumps(obj).decode('utf-8')
+elif msgspec is not None:
+    JSON_BACKEND = 'msgspec'
+    _JSON_ENCODER = msgspec.json.Encoder()
+    _JSON_DECODER = msgspec.json.Decoder()
+    
+    def json_loads(data):
+        """Decode JSON from str or bytes"""
+        return _JSON_DECODER.decode(data)
+    
+    def json_dumps(obj):
+        """Encode JSON compactly"""
+        return _JSON_ENCODER.encode(obj).decode('utf-8')
+else:
+    JSON_BACKEND = 'json'
+    
+    def json_loads(data):
+        """Decode JSON from str or bytes"""
+        return json.loads(data)
+    
+    def json_dumps(obj):
+        """Encode JSON compactly"""
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+# Catalog page schema: only the fields Product.from_api and the crawler read.
+# With msgspec everything else in the payload is skipped while decoding.
+class CatalogPrice(TypedDict, total=False):
+    formattedValue: Optional[str]
+
+class CatalogStock(TypedDict, total=False):
+    stockLevelStatus: Optional[str]
+
+class CatalogImage(TypedDict, total=False):
+    url: Optional[str]
+    format: Optional[str]
+    imageType: Optional[str]
+
+class CatalogTagName(TypedDict, total=False):
+    name: Optional[str]
+
+class CatalogTag(TypedDict, total=False):
+    category: Optional[str]
+    primary: Optional[CatalogTagName]
+
+class CatalogTags(TypedDict, total=False):
+    categoryTags: Optional[List[CatalogTag]]
+
+class CatalogColorVariant(TypedDict, total=False):
+    colorGroup: Optional[str]
+
+class CatalogProduct(TypedDict, total=False):
+    code: Optional[str]
+    name: Optional[str]
+    price: Optional[CatalogPrice]
+    offerPrice: Optional[CatalogPrice]
+    stock: Optional[CatalogStock]
+    averageRating: Optional[float]
+    ratingCount: Optional[int]
+    url: Optional[str]
+    fnlColorVariantData: Optional[CatalogColorVariant]
+    images: Optional[List[CatalogImage]]
+    tags: Optional[CatalogTags]
+
+class CatalogPagination(TypedDict, total=False):
+    currentPage: Optional[int]
+    pageSize: Optional[int]
+    totalPages: Optional[int]
+    totalResults: Optional[int]
+
+class CatalogPage(TypedDict, total=False):
+    products: Optional[List[CatalogProduct]]
+    pagination: Optional[CatalogPagination]
+
+CATALOG_PAGE_DECODER = msgspec.json.Decoder(CatalogPage) if msgspec is not None else None
+
+def decode_catalog_page(body):
+    """Decode a catalog page body, keeping only schema fields when msgspec is available"""
+    if CATALOG_PAGE_DECODER is not None:
+        try:
+            return CATALOG_PAGE_DECODER.decode(body)
+        except msgspec.ValidationError as e:
+            # The API changed a field's type, fall back to untyped decoding
+            logger.warning(f"Catalog page didn't match the schema, decoding untyped: {e}")
+    return json_loads(body)
+
+# --- COOKIE SESSION ---
+
+def make_cookie(name, value, domain, path='/', secure=False, expires=None):
+    """Build a cookiejar Cookie the same way c.py does"""
+    return cookiejar.Cookie(
+        version=0, name=name, value=value,
+        port=None, port_specified=False,
+        domain=domain, domain_specified=bool(domain), domain_initial_dot=domain.startswith('.'),
+        path=path, path_specified=True,
+        secure=secure, expires=expires,
+        discard=False, comment=None, comment_url=None,
+        rest={}, rfc2109=False
+    )
+
+def save_cookie_file(path, cookies):
+    """Write cookies to a Mozilla cookies.txt file, replacing the old file atomically"""
+    jar = cookiejar.MozillaCookieJar(path + '.tmp')
+    for cookie in cookies:
+        jar.set_cookie(cookie)
+    jar.save(ignore_discard=True, ignore_expires=True)
+    os.replace(path + '.tmp', path)
+
+class CookieSession:
+    """Owns the one cookie jar every HTTP client uses and keeps it fresh with c.py's warm-up request"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._jar = None
+        self.refresh_task = None
+        self.last_refresh_at = 0.0  # time.monotonic() of the last refresh attempt
+        self.expiries = []  # expiry times of the cookies the last successful warm-up set
+        self.refreshes = 0
+        self.failures = 0
+    
+    @property
+    def jar(self):
+        """The shared jar, loaded on first use"""
+        if self._jar is None:
+            self._jar = self.load()
+        return self._jar
+    
+    def load(self):
+        """Load COOKIES_FILE, falling back to the built-in COOKIES"""
+        jar = cookiejar.MozillaCookieJar(self.path)
+        if os.path.exists(self.path):
+            try:
+                jar.load(ignore_discard=True, ignore_expires=True)
+                logger.info(f"Loaded {len(jar)} cookies from {self.path}")
+                return jar
+            except (OSError, cookiejar.LoadError) as e:
+                logger.error(f"Could not read {self.path}, using the built-in cookies: {e}")
+        for name, value in COOKIES.items():
+            jar.set_cookie(make_cookie(name, value, COOKIE_DOMAIN))
+        return jar
+    
+    def start_refresh(self, reason):
+        """Start a refresh unless one is running or the last one was moments ago; returns its task or None"""
+        if self.refresh_task is not None:
+            return self.refresh_task
+        if time.monotonic() - self.last_refresh_at < COOKIE_REFRESH_MIN_GAP:
+            return None
+        self.last_refresh_at = time.monotonic()
+        task = asyncio.ensure_future(self._refresh(reason))
+        self.refresh_task = task
+        task.add_done_callback(self._refresh_done)
+        return task
+    
+    async def refresh(self, reason):
+        """Refresh the cookies and wait for it; concurrent callers share one refresh. True if new cookies arrived"""
+        task = self.start_refresh(reason)
+        if task is None:
+            return False
+        return await asyncio.shield(task)
+    
+    async def _refresh(self, reason):
+        logger.info(f"Refreshing SHEIN cookies ({reason})")
+        try:
+            # A fresh client without the old cookies, like the new requests.Session() in c.py
+            async with httpx.AsyncClient(http2=HTTP2_AVAILABLE, headers={'user-agent': HEADERS['user-agent']},
+                                         timeout=HTTP_TIMEOUT, follow_redirects=True) as client:
+                response = await client.get(COOKIE_WARMUP_URL)
+                fresh = list(client.cookies.jar)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Cookie refresh failed: {e}")
+            return False
+        if not fresh:
+            self.failures += 1
+            logger.error(f"Cookie refresh got no cookies (HTTP {response.status_code})")
+            return False
+        
+        # Merged without awaiting in between, so in-flight and new requests never see a half-updated jar
+        for cookie in fresh:
+            self.jar.set_cookie(cookie)
+        # Stale cookies the warm-up didn't set again would otherwise keep a refresh due forever
+        self.jar.clear_expired_cookies()
+        self.expiries = [cookie.expires for cookie in fresh if cookie.expires]
+        self.refreshes += 1
+        logger.info(f"Refreshed {len(fresh)} cookies")
+        await run_blocking(save_cookie_file, self.path, list(self.jar))
+        return True
+    
+    def _refresh_done(self, task):
+        if self.refresh_task is task:
+            self.refresh_task = None
+    
+    def seconds_until_refresh(self):
+        """Seconds until the next background refresh is due"""
+        delay = self.last_refresh_at + COOKIE_REFRESH_INTERVAL - time.monotonic()
+        # Until the first refresh, the loaded cookies decide; after that only the ones the warm-up set
+        expiries = self.expiries if self.last_refresh_at else [cookie.expires for cookie in self.jar if cookie.expires]
+        if expiries:
+            delay = min(delay, min(expiries) - COOKIE_REFRESH_MARGIN - time.time())
+        return max(delay, COOKIE_REFRESH_MIN_GAP)
+    
+    async def run(self):
+        """Background loop refreshing the cookies before they expire"""
+        while True:
+            await asyncio.sleep(self.seconds_until_refresh())
+            try:
+                await self.refresh('scheduled')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in cookie refresh loop: {e}")
+
+COOKIE_SESSION = CookieSession(COOKIES_FILE)
+
+# --- HTTP CLIENT ---
+
+def get_http_client():
+    """Return the shared pooled HTTP client, creating it on first use"""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            headers=HEADERS,
+            cookies=COOKIE_SESSION.jar,  # shared jar, so refreshed cookies apply to every request
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+    return HTTP_CLIENT
+
+async def http_get(url, params=None, headers=None):
+    """GET a URL through the shared client, limiting concurrent requests per host"""
+    host = httpx.URL(url).host
+    semaphore = HOST_SEMAPHORES.get(host)
+    if semaphore is None:
+        semaphore = HOST_SEMAPHORES[host] = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    async with semaphore:
+        return await get_http_client().get(url, params=params, headers=headers)
+
+async def close_http_client():
+    """Close the shared HTTP client and its pooled connections"""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+
+# --- RATE LIMITING ---
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` tokens per second, holding at most `capacity`"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        """Drain the bucket so nothing is sent for the given number of seconds"""
+        self.tokens = -seconds * self.rate
+        self.updated_at = time.monotonic()
+
+class AdaptiveRateLimiter(TokenBucket):
+    """Token bucket whose rate grows additively on success and halves when upstream throttles us"""
+    
+    def __init__(self, rate, min_rate, max_rate, cooldown):
+        super().__init__(rate, capacity=max(1, rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.cooldown = cooldown
+        self.last_throttle_at = 0
+        self.throttled = 0
+    
+    def on_success(self):
+        """Speed up by roughly one request per second for every second of clean responses"""
+        self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+        self.capacity = max(1, self.rate)
+    
+    def on_throttle(self):
+        """Halve the rate and pause briefly (at most once per cooldown, since in-flight calls fail together)"""
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self.last_throttle_at < self.cooldown:
+            return
+        self.last_throttle_at = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.capacity = max(1, self.rate)
+        self.pause(self.cooldown)
+        logger.warning(f"Delivery API is throttling us, slowing down to {self.rate:.1f} requests/sec")
+
+DELIVERY_LIMITER = AdaptiveRateLimiter(DELIVERY_INITIAL_RATE, DELIVERY_MIN_RATE, DELIVERY_MAX_RATE, DELIVERY_THROTTLE_COOLDOWN)
+DELIVERY_SEMAPHORE = asyncio.Semaphore(DELIVERY_MAX_CONCURRENCY)
+
+# --- DELIVERY CACHE ---
+
+class TTLCache:
+    """LRU cache with per-entry TTL that coalesces concurrent loads of the same key"""
+    
+    def __init__(self, ttl, negative_ttl, max_size, is_failure=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.is_failure = is_failure or (lambda value: value is None)
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.inflight = {}  # key -> task loading that key
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.started_at = time.monotonic()
+    
+    async def get(self, key, loader):
+        """Return the cached value for key, calling loader() once on a miss"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        
+        task = self.inflight.get(key)
+        if task is not None:
+            # Someone is already fetching this key, wait for their result
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        
+        self.misses += 1
+        task = asyncio.ensure_future(loader())
+        self.inflight[key] = task
+        task.add_done_callback(lambda done: self._store(key, done))
+        return await asyncio.shield(task)
+    
+    def _store(self, key, task):
+        """Cache a finished load, using the shorter TTL for failures"""
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        ttl = self.negative_ttl if self.is_failure(value) else self.ttl
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        """Drop one cached entry so the next get() loads it again"""
+        self.entries.pop(key, None)
+    
+    def clear(self):
+        """Drop all cached entries"""
+        self.entries.clear()
+    
+    def stats(self):
+        """Return hit/miss counters and the upstream calls saved per hour"""
+        lookups = self.hits + self.misses + self.coalesced
+        saved = self.hits + self.coalesced
+        hours = max((time.monotonic() - self.started_at) / 3600, 1 / 3600)
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': saved / lookups if lookups else 0.0,
+            'saved_per_hour': saved / hours,
+        }
+
+DELIVERY_CACHE = TTLCache(
+    DELIVERY_CACHE_TTL,
+    DELIVERY_CACHE_NEGATIVE_TTL,
+    DELIVERY_CACHE_MAX_SIZE,
+    is_failure=lambda info: info.get('failed', False)
+)
+
+# --- PRODUCT MODEL ---
+
+def product_color(raw):
+    """Color name from a raw product's fnlColorVariantData ('group_black' -> 'black')"""
+    color_group = (raw.get('fnlColorVariantData') or {}).get('colorGroup', '') or ''
+    return color_group.split('_')[-1] if '_' in color_group else color_group
+
+@dataclass(frozen=True, slots=True)
+class Product:
+    """Compact product record holding only what formatting and the catalog diff read.
+    
+    Built once when a catalog page is parsed; the raw API dict is not retained.
+    """
+    code: str
+    name: str = 'Unknown Product'
+    price: str = ''
+    offer_price: str = ''
+    stock: str = ''
+    rating: float = 0
+    rating_count: int = 0
+    url: str = ''
+    color: str = ''
+    image_url: str = ''
+    tags: tuple = ()
+    
+    @classmethod
+    def from_api(cls, raw):
+        """Build a Product from a raw catalog API product dict"""
+        # Get color from the product data
+        color = product_color(raw)
+        
+        # Get primary image - prefer the PRIMARY product image, else any image with a URL
+        images = raw.get('images') or []
+        image_url = next((img.get('url') or '' for img in images
+                          if img.get('format') == 'product' and img.get('imageType') == 'PRIMARY'), '')
+        if not image_url:
+            image_url = next((img['url'] for img in images if img.get('url')), '')
+        
+        # Get selling-point tags
+        tags = tuple(
+            (tag.get('primary') or {}).get('name') or ''
+            for tag in (raw.get('tags') or {}).get('categoryTags') or []
+            if tag.get('category') == 'SELLING_POINT'
+        )
+        
+        return cls(
+            code=raw.get('code') or '',
+            name=raw.get('name') or 'Unknown Product',
+            price=(raw.get('price') or {}).get('formattedValue') or '',
+            offer_price=(raw.get('offerPrice') or {}).get('formattedValue') or '',
+            stock=(raw.get('stock') or {}).get('stockLevelStatus') or '',
+            rating=raw.get('averageRating') or 0,
+            rating_count=raw.get('ratingCount') or 0,
+            url=raw.get('url') or '',
+            color=color,
+            image_url=image_url,
+            tags=tags,
+        )
+    
+    @classmethod
+    def from_stored(cls, data):
+        """Build a Product from persisted state (compact records, or raw dicts from older versions)"""
+        if isinstance(data.get('price'), dict) or 'images' in data:
+            return cls.from_api(data)
+        data = dict(data)
+        data['tags'] = tuple(data.get('tags', ()))
+        return cls(**{name: data[name] for name in cls.__dataclass_fields__ if name in data})
+    
+    def to_stored(self):
+        """Compact dict for persistence"""
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+# --- STATE STORE ---
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS product_codes (
+    code TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS products (
+    code TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stock_states (
+    code TEXT PRIMARY KEY,
+    state INTEGER NOT NULL,
+    misses INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_stock_states_state ON stock_states (state);
+CREATE TABLE IF NOT EXISTS notification_ledger (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    notified_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS idx_notification_ledger_expires_at ON notification_ledger (expires_at);
+CREATE INDEX IF NOT EXISTS idx_notification_ledger_notified_at ON notification_ledger (kind, notified_at);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt_at ON outbox (next_attempt_at);
+CREATE TABLE IF NOT EXISTS price_history (
+    code TEXT PRIMARY KEY,
+    timestamps BLOB NOT NULL,
+    prices BLOB NOT NULL,
+    offer_prices BLOB NOT NULL,
+    low REAL,
+    high REAL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Notification ledger kinds
+NOTIFIED_NEW_PRODUCT = 'new_product'
+NOTIFIED_OUT_OF_STOCK = 'out_of_stock'
+NOTIFIED_PRICE_CHANGE = 'price_change'
+NOTIFIED_RESTOCK = 'restock'
+
+# Outbox priorities: a chat's alerts go out ahead of its bulk command output
+NOTIFY_PRIORITY_ALERT = 0
+NOTIFY_PRIORITY_BULK = 1
+
+# Stock states (products that are simply listed and in stock have no stored row)
+STOCK_ACTIVE = 0  # listed and in stock
+STOCK_MISSING = 1  # dropped out of the listing, waiting for confirmation
+STOCK_OUT = 2  # confirmed out of stock
+STOCK_RESTOCKED = 3  # listed again after being confirmed out of stock
+
+def get_state_db():
+    """Return the state database connection, creating and migrating it on first use"""
+    global STATE_DB
+    if STATE_DB is None:
+        db = sqlite3.connect(STATE_DB_FILE, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(STATE_SCHEMA)
+        migrate_flat_files(db)
+        migrate_legacy_tables(db)
+        STATE_DB = db
+    return STATE_DB
+
+def read_lines_file(path):
+    """Read a legacy one-code-per-line file"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+def read_json_file(path):
+    """Read a legacy JSON file"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json_loads(f.read())
+    except Exception:
+        return {}
+
+def migrate_flat_files(db):
+    """Import the legacy txt/json state files into the database once"""
+    if db.execute("SELECT 1 FROM meta WHERE key = 'flat_files_migrated'").fetchone():
+        return
+    
+    now = time.time()
+    migrated_at = datetime.now().isoformat()
+    with db:
+        db.executemany("INSERT OR IGNORE INTO product_codes (code) VALUES (?)",
+                       [(code,) for code in read_lines_file(PRODUCT_CODES_FILE)])
+        db.executemany("INSERT OR REPLACE INTO products (code, data, updated_at) VALUES (?, ?, ?)",
+                       [(code, json_dumps(Product.from_api(product).to_stored()), now)
+                        for code, product in read_json_file(PRODUCT_DETAILS_FILE).items()])
+        db.executemany("INSERT OR REPLACE INTO stock_states (code, state, updated_at) VALUES (?, ?, ?)",
+                       [(code, STOCK_OUT, now) for code in read_lines_file(OUT_OF_STOCK_FILE)])
+        for kind, keys in ((NOTIFIED_OUT_OF_STOCK, read_lines_file(NOTIFIED_OUT_OF_STOCK_FILE)),
+                           (NOTIFIED_NEW_PRODUCT, read_lines_file(NOTIFIED_NEW_PRODUCTS_FILE)),
+                           (NOTIFIED_PRICE_CHANGE, read_json_file(NOTIFIED_PRICE_CHANGES_FILE))):
+            db.executemany("INSERT OR IGNORE INTO notification_ledger (kind, key, notified_at, expires_at) VALUES (?, ?, ?, ?)",
+                           [(kind, key, now, now + notified_ttl(kind)) for key in keys])
+        db.execute("INSERT INTO meta (key, value) VALUES ('flat_files_migrated', ?)", (migrated_at,))
+    logger.info(f"State database ready at {STATE_DB_FILE}")
+
+def migrate_legacy_tables(db):
+    """Move tables from older versions of the schema into their replacements"""
+    tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    now = time.time()
+    if 'notifications' in tables:
+        # Unbounded notifications table -> TTL'd ledger (entries restart their TTL)
+        with db:
+            for kind in NOTIFIED_TTLS:
+                db.execute("INSERT OR IGNORE INTO notification_ledger (kind, key, notified_at, expires_at) "
+                           "SELECT kind, key, ?, ? FROM notifications WHERE kind = ?", (now, now + notified_ttl(kind), kind))
+            db.execute("DROP TABLE notifications")
+        logger.info("Notification ledger migrated")
+    if 'stock_state' in tables:
+        # Out-of-stock flags -> stock state machine
+        with db:
+            db.execute("INSERT OR IGNORE INTO stock_states (code, state, updated_at) "
+                       "SELECT code, ?, updated_at FROM stock_state WHERE out_of_stock = 1", (STOCK_OUT,))
+            db.execute("DROP TABLE stock_state")
+        logger.info("Stock states migrated")
+    if 'priority' not in set(row[1] for row in db.execute("PRAGMA table_info(outbox)")):
+        # Outbox rows from before priorities were all sent in queue order
+        with db:
+            db.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            db.execute("DROP INDEX IF EXISTS idx_outbox_chat_id")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat_priority ON outbox (chat_id, priority, id)")
+
+def load_product_codes():
+    """Load existing product codes"""
+    return set(row[0] for row in get_state_db().execute("SELECT code FROM product_codes"))
+
+def save_product_codes(codes):
+    """Save product codes (only codes not stored yet are written)"""
+    if not codes:
+        return
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT OR IGNORE INTO product_codes (code) VALUES (?)", [(code,) for code in codes])
+
+def load_baselined_scopes():
+    """Watch scopes whose products were already recorded by a first, silent sweep"""
+    return set(row[0][len('baseline:'):] for row in get_state_db().execute("SELECT key FROM meta WHERE key LIKE 'baseline:%'"))
+
+def save_baselined_scopes(scopes):
+    """Mark watch scopes as baselined"""
+    now = str(time.time())
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", [(f"baseline:{scope}", now) for scope in scopes])
+
+def load_product_details():
+    """Load product details keyed by product code"""
+    return {code: Product.from_stored(json_loads(data)) for code, data in get_state_db().execute("SELECT code, data FROM products")}
+
+def save_product_details(details):
+    """Upsert product details for the given codes (pass only products that changed)"""
+    if not details:
+        return
+    now = time.time()
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT OR REPLACE INTO products (code, data, updated_at) VALUES (?, ?, ?)",
+                       [(code, json_dumps(product.to_stored()), now) for code, product in details.items()])
+
+def load_stock_states():
+    """Load (code, state, misses) for every product that is not simply active"""
+    return get_state_db().execute("SELECT code, state, misses FROM stock_states").fetchall()
+
+def save_stock_states(changes):
+    """Write stock state transitions {code: (state, misses)}; products back to active lose their row"""
+    if not changes:
+        return
+    now = time.time()
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT OR REPLACE INTO stock_states (code, state, misses, updated_at) VALUES (?, ?, ?, ?)",
+                       [(code, state, misses, now) for code, (state, misses) in changes.items() if state != STOCK_ACTIVE])
+        db.executemany("DELETE FROM stock_states WHERE code = ?",
+                       [(code,) for code, (state, _) in changes.items() if state == STOCK_ACTIVE])
+
+def load_delisted_codes(cutoff):
+    """Codes that went out of stock before the cutoff timestamp and stayed there"""
+    return [row[0] for row in get_state_db().execute(
+        "SELECT code FROM stock_states WHERE state = ? AND updated_at < ?", (STOCK_OUT, cutoff)
+    )]
+
+def delete_products(codes):
+    """Forget products entirely (price history stays, so a comeback still knows its all-time low)"""
+    if not codes:
+        return
+    rows = [(code,) for code in codes]
+    db = get_state_db()
+    with db:
+        for table in ('product_codes', 'products', 'stock_states'):
+            db.executemany(f"DELETE FROM {table} WHERE code = ?", rows)
+
+def notified_ttl(kind):
+    """Seconds a notification of this kind suppresses repeats"""
+    return NOTIFIED_TTLS.get(kind, max(NOTIFIED_TTLS.values()))
+
+def load_notified(kind, keys):
+    """Return which of the given keys have an unexpired notification of this kind"""
+    keys = list(keys)
+    now = time.time()
+    db = get_state_db()
+    found = set()
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        found.update(row[0] for row in db.execute(
+            f"SELECT key FROM notification_ledger WHERE kind = ? AND expires_at > ? AND key IN ({','.join('?' * len(chunk))})",
+            (kind, now, *chunk)
+        ))
+    return found
+
+def save_notified(kind, keys):
+    """Append notifications to the ledger (keys notified before restart their TTL)"""
+    if not keys:
+        return
+    now = time.time()
+    expires_at = now + notified_ttl(kind)
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT INTO notification_ledger (kind, key, notified_at, expires_at) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(kind, key) DO UPDATE SET notified_at = excluded.notified_at, expires_at = excluded.expires_at",
+                       [(kind, key, now, expires_at) for key in keys])
+
+def iter_notified():
+    """Yield (kind, key) for every unexpired ledger entry"""
+    yield from get_state_db().execute("SELECT kind, key FROM notification_ledger WHERE expires_at > ?", (time.time(),))
+
+def compact_notified():
+    """Drop expired ledger entries and all but the newest NOTIFIED_MAX_ENTRIES per kind; returns rows removed"""
+    db = get_state_db()
+    with db:
+        removed = db.execute("DELETE FROM notification_ledger WHERE expires_at <= ?", (time.time(),)).rowcount
+        for kind, count in db.execute("SELECT kind, COUNT(*) FROM notification_ledger GROUP BY kind").fetchall():
+            if count > NOTIFIED_MAX_ENTRIES:
+                removed += db.execute(
+                    "DELETE FROM notification_ledger WHERE kind = ? AND rowid NOT IN "
+                    "(SELECT rowid FROM notification_ledger WHERE kind = ? ORDER BY notified_at DESC, rowid DESC LIMIT ?)",
+                    (kind, kind, NOTIFIED_MAX_ENTRIES)
+                ).rowcount
+    return removed
+
+def clear_notified(kinds=None, keys=None):
+    """Clear the notification ledger: everything, or only the given kinds and/or keys; returns rows removed"""
+    clauses, params = [], []
+    if kinds:
+        clauses.append(f"kind IN ({','.join('?' * len(kinds))})")
+        params.extend(kinds)
+    if keys:
+        # Price change keys are f"{code}_{old}_{new}" (prices start with '₹'), so a product code matches those too
+        clauses.append(f"({' OR '.join(['key = ? OR substr(key, 1, length(?) + 2) = ? || ?'] * len(keys))})")
+        for key in keys:
+            params.extend((key, key, key, '_₹'))
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    db = get_state_db()
+    with db:
+        return db.execute(f"DELETE FROM notification_ledger{where}", params).rowcount
+
+def add_to_outbox(messages, delay=0, priority=NOTIFY_PRIORITY_ALERT):
+    """Append (chat_id, payload) messages to the persistent outbox.
+    
+    With a delay the messages join the chat's open coalescing window (or open a new
+    one), so everything queued within the window becomes due at the same moment.
+    """
+    if not messages:
+        return
+    now = time.time()
+    db = get_state_db()
+    due_times = {}
+    for chat_id, _ in messages:
+        chat_id = str(chat_id)
+        if chat_id in due_times:
+            continue
+        due_at = now
+        if delay:
+            # Pending rows that were never attempted and aren't due yet belong to an open window
+            open_window = db.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE chat_id = ? AND attempts = 0 AND next_attempt_at > ?",
+                (chat_id, now)
+            ).fetchone()[0]
+            due_at = open_window if open_window is not None else now + delay
+        due_times[chat_id] = due_at
+    with db:
+        db.executemany("INSERT INTO outbox (chat_id, payload, next_attempt_at, created_at, priority) VALUES (?, ?, ?, ?, ?)",
+                       [(str(chat_id), json_dumps(payload), due_times[str(chat_id)], now, priority) for chat_id, payload in messages])
+
+# An outbox row is held back while a row queued ahead of it in the same chat waits for a retry
+OUTBOX_NOT_BLOCKED = ("NOT EXISTS (SELECT 1 FROM outbox AS w WHERE w.chat_id = o.chat_id AND w.attempts > 0 AND w.next_attempt_at > ? "
+                      "AND (w.priority < o.priority OR (w.priority = o.priority AND w.id < o.id)))")
+
+def load_due_outbox_chats():
+    """Chats that have outbox messages due for sending and not held back by a retry"""
+    now = time.time()
+    return [row[0] for row in get_state_db().execute(
+        f"SELECT DISTINCT chat_id FROM outbox AS o WHERE next_attempt_at <= ? AND {OUTBOX_NOT_BLOCKED}", (now, now)
+    )]
+
+def load_due_outbox(chat_id, limit):
+    """Load one chat's outbox messages that are due for sending, alerts first, then oldest first.
+    
+    Nothing queued behind a message that is waiting for a retry is returned, to keep the chat's order.
+    """
+    now = time.time()
+    rows = get_state_db().execute(
+        f"SELECT id, chat_id, payload, attempts FROM outbox AS o WHERE chat_id = ? AND next_attempt_at <= ? AND {OUTBOX_NOT_BLOCKED} "
+        "ORDER BY priority, id LIMIT ?",
+        (chat_id, now, now, limit)
+    )
+    return [(row_id, chat_id, json_loads(payload), attempts) for row_id, chat_id, payload, attempts in rows]
+
+def next_outbox_due_time():
+    """Return when the next outbox message that isn't due yet becomes due, or None if there is none"""
+    return get_state_db().execute("SELECT MIN(next_attempt_at) FROM outbox WHERE next_attempt_at > ?", (time.time(),)).fetchone()[0]
+
+def remove_from_outbox(row_ids):
+    """Delete sent (or abandoned) outbox messages"""
+    db = get_state_db()
+    with db:
+        db.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+def reschedule_outbox(row_id, attempts, next_attempt_at):
+    """Record a failed send and when to try again"""
+    db = get_state_db()
+    with db:
+        db.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?", (attempts, next_attempt_at, row_id))
+
+def count_outbox():
+    """Number of notifications waiting to be sent"""
+    return get_state_db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+def save_monitor_changes(new_codes, changed_products, stock_changes):
+    """Persist one monitor tick's changes (only rows that changed are written).
+    
+    Returns the price signals for the changed products' new price points.
+    """
+    save_product_codes(new_codes)
+    save_product_details(changed_products)
+    save_stock_states(stock_changes)
+    return record_prices(changed_products.values(), time.time())
+
+def get_state_counts():
+    """Count stored state rows with indexed queries (used by /status)"""
+    db = get_state_db()
+    counts = {
+        'product_codes': db.execute("SELECT COUNT(*) FROM product_codes").fetchone()[0],
+        'stock': {state: 0 for state in (STOCK_MISSING, STOCK_OUT, STOCK_RESTOCKED)},
+        'notified': {},
+    }
+    counts['stock'].update(db.execute("SELECT state, COUNT(*) FROM stock_states GROUP BY state"))
+    for kind in (NOTIFIED_NEW_PRODUCT, NOTIFIED_OUT_OF_STOCK, NOTIFIED_RESTOCK, NOTIFIED_PRICE_CHANGE):
+        counts['notified'][kind] = 0
+    counts['notified'].update(db.execute("SELECT kind, COUNT(*) FROM notification_ledger WHERE expires_at > ? GROUP BY kind", (time.time(),)))
+    return counts
+
+def close_state_db():
+    """Close the state database connection"""
+    global STATE_DB
+    if STATE_DB is not None:
+        STATE_DB.close()
+        STATE_DB = None
+
+# --- NOTIFICATION LEDGER ---
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: no false negatives, a tunable rate of false positives"""
+    __slots__ = ('bits', 'size', 'hashes', 'count')
+    
+    def __init__(self, size, hashes):
+        self.bits = bytearray((size + 7) // 8)
+        self.size = size
+        self.hashes = hashes
+        self.count = 0
+    
+    def positions(self, item):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(hash1 + i * hash2) % self.size for i in range(self.hashes)]
+    
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+def ledger_item(kind, key):
+    return f"{kind}\0{key}"
+
+class NotificationLedger:
+    """Alert dedup ledger: TTL'd rows in the state database behind an in-memory Bloom filter.
+    
+    Keys the filter has never seen are answered without touching the database, so only
+    filter hits are confirmed there. A Bloom filter cannot forget, so it is rebuilt from
+    the surviving rows whenever compaction or /reset removes entries.
+    """
+    
+    def __init__(self, filter_bits, filter_hashes):
+        self.filter_bits = filter_bits
+        self.filter_hashes = filter_hashes
+        self.filter = None  # built from the database on first use
+        self.pending = None  # items recorded while a rebuild is reading the database
+        self.rebuild_lock = asyncio.Lock()
+        self.stats = {'lookups': 0, 'filtered': 0, 'false_positives': 0, 'compactions': 0, 'compacted': 0}
+    
+    def build_filter(self):
+        """Read every unexpired entry into a fresh filter (runs on the database thread)"""
+        bloom = BloomFilter(self.filter_bits, self.filter_hashes)
+        for kind, key in iter_notified():
+            bloom.add(ledger_item(kind, key))
+        return bloom
+    
+    async def rebuild(self):
+        async with self.rebuild_lock:
+            self.pending = []
+            try:
+                bloom = await run_db(self.build_filter)
+            except BaseException:
+                self.pending = None
+                raise
+            for item in self.pending:
+                bloom.add(item)
+            self.filter, self.pending = bloom, None
+    
+    async def seen(self, kind, keys):
+        """Return the keys that were already notified for this kind and have not expired"""
+        if self.filter is None:
+            await self.rebuild()
+        candidates = [key for key in keys if ledger_item(kind, key) in self.filter]
+        self.stats['lookups'] += len(keys)
+        self.stats['filtered'] += len(keys) - len(candidates)
+        if not candidates:
+            return set()
+        found = await run_db(load_notified, kind, candidates)
+        self.stats['false_positives'] += len(candidates) - len(found)
+        return found
+    
+    async def record(self, kind, keys):
+        """Mark keys as notified for this kind"""
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            item = ledger_item(kind, key)
+            if self.filter is not None:
+                self.filter.add(item)
+            if self.pending is not None:
+                self.pending.append(item)
+        await run_db(save_notified, kind, keys)
+    
+    async def compact(self):
+        """Drop expired and excess entries from disk, then shrink the filter to match"""
+        removed = await run_db(compact_notified)
+        self.stats['compactions'] += 1
+        self.stats['compacted'] += removed
+        if removed or self.filter is None:
+            await self.rebuild()
+        return removed
+    
+    async def clear(self, kinds=None, keys=None):
+        """Forget notifications (all, or only some kinds and/or keys) so they can alert again"""
+        removed = await run_db(clear_notified, kinds, keys)
+        if removed:
+            await self.rebuild()
+        return removed
+    
+    async def run(self):
+        """Compact the ledger in the background"""
+        while True:
+            try:
+                removed = await self.compact()
+                if removed:
+                    logger.info(f"Notification ledger compacted: {removed} entries dropped")
+            except Exception as e:
+                logger.error(f"Error compacting the notification ledger: {e}")
+            await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+
+NOTIFICATION_LEDGER = NotificationLedger(LEDGER_FILTER_BITS, LEDGER_FILTER_HASHES)
+
+# --- PRICE HISTORY ---
+
+def parse_price(text):
+    """Numeric value of a formatted price like '₹1,299' (0.0 when missing)"""
+    digits = re.sub(r'[^\d.]', '', text or '')
+    try:
+        return float(digits) if digits else 0.0
+    except ValueError:
+        return 0.0
+
+class PriceSeries:
+    """Price points of one product as packed columns of doubles.
+    
+    low/high are all-time aggregates, kept when old points are compacted or dropped,
+    so new points are judged against them without rescanning the history.
+    """
+    __slots__ = ('timestamps', 'prices', 'offer_prices', 'low', 'high')
+    
+    def __init__(self, timestamps=None, prices=None, offer_prices=None, low=None, high=None):
+        self.timestamps = timestamps if timestamps is not None else array('d')
+        self.prices = prices if prices is not None else array('d')
+        self.offer_prices = offer_prices if offer_prices is not None else array('d')  # 0.0 = no offer
+        self.low = low
+        self.high = high
+    
+    @classmethod
+    def from_row(cls, timestamps, prices, offer_prices, low, high):
+        columns = []
+        for blob in (timestamps, prices, offer_prices):
+            column = array('d')
+            column.frombytes(blob)
+            columns.append(column)
+        return cls(*columns, low, high)
+    
+    def to_row(self):
+        return self.timestamps.tobytes(), self.prices.tobytes(), self.offer_prices.tobytes(), self.low, self.high
+    
+    def __len__(self):
+        return len(self.timestamps)
+    
+    def effective(self, index):
+        """Price actually paid at a point: the offer price when there is one"""
+        return self.offer_prices[index] or self.prices[index]
+    
+    def last(self):
+        return self.effective(-1) if self.timestamps else None
+    
+    def append(self, timestamp, price, offer_price):
+        self.timestamps.append(timestamp)
+        self.prices.append(price)
+        self.offer_prices.append(offer_price)
+        effective = offer_price or price
+        self.low = effective if self.low is None else min(self.low, effective)
+        self.high = effective if self.high is None else max(self.high, effective)
+    
+    def low_since(self, since):
+        """Lowest effective price at or after a timestamp, or None"""
+        start = bisect.bisect_left(self.timestamps, since)
+        if start > 0:
+            start -= 1  # The price in effect at `since` was set by the point before it
+        if start >= len(self):
+            return None
+        return min(self.effective(index) for index in range(start, len(self)))
+    
+    def last_n(self, count):
+        """The last count points as (timestamp, price, offer price) tuples"""
+        return list(zip(self.timestamps[-count:], self.prices[-count:], self.offer_prices[-count:]))
+    
+    def compact(self, now):
+        """Drop points past retention and keep only the lowest point per day for old ones"""
+        retention_start = now - PRICE_HISTORY_RETENTION_DAYS * 86400
+        compact_before = now - PRICE_HISTORY_COMPACT_AFTER_DAYS * 86400
+        keep = []
+        daily_low = {}  # day -> index of its lowest point, for points older than compact_before
+        for index, timestamp in enumerate(self.timestamps):
+            if timestamp < retention_start:
+                continue
+            if timestamp >= compact_before or index == len(self) - 1:
+                keep.append(index)
+                continue
+            day = int(timestamp // 86400)
+            best = daily_low.get(day)
+            if best is None or self.effective(index) < self.effective(best):
+                daily_low[day] = index
+        keep = sorted(set(keep) | set(daily_low.values()))
+        self.timestamps = array('d', (self.timestamps[index] for index in keep))
+        self.prices = array('d', (self.prices[index] for index in keep))
+        self.offer_prices = array('d', (self.offer_prices[index] for index in keep))
+
+# Trend signal for one new price point, turned into a price change alert
+PriceSignal = namedtuple('PriceSignal', ['code', 'old', 'new', 'change_pct', 'all_time_low'])
+
+def load_price_series(code):
+    """Load one product's price history, or None"""
+    row = get_state_db().execute(
+        "SELECT timestamps, prices, offer_prices, low, high FROM price_history WHERE code = ?", (code,)
+    ).fetchone()
+    return PriceSeries.from_row(*row) if row else None
+
+def record_prices(products, timestamp):
+    """Append a price point for every product whose price or offer changed and evaluate the alert rules.
+    
+    Only the product's last point and all-time aggregates are consulted. Returns a list of PriceSignals.
+    """
+    signals = []
+    rows = []
+    for product in products:
+        price = parse_price(product.price)
+        offer_price = parse_price(product.offer_price)
+        if not (offer_price or price):
+            continue
+        series = load_price_series(product.code) or PriceSeries()
+        if series and series.prices[-1] == price and series.offer_prices[-1] == offer_price:
+            continue  # Something other than the price changed
+        
+        old = series.last()
+        new = offer_price or price
+        if old and new != old:
+            change_pct = (new - old) / old * 100
+            all_time_low = new < series.low
+            if all_time_low or (abs(change_pct) >= PRICE_ALERT_MIN_CHANGE_PCT and not (PRICE_ALERT_DROPS_ONLY and change_pct > 0)):
+                signals.append(PriceSignal(product.code, old, new, change_pct, all_time_low))
+        
+        series.append(timestamp, price, offer_price)
+        if len(series) > PRICE_HISTORY_COMPACT_AT:
+            series.compact(timestamp)
+        rows.append((product.code, *series.to_row(), timestamp))
+    
+    db = get_state_db()
+    with db:
+        db.executemany("INSERT OR REPLACE INTO price_history (code, timestamps, prices, offer_prices, low, high, updated_at) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return signals
+
+def backfill_price_history(products):
+    """Give every known product without a history its current price as a first point"""
+    db = get_state_db()
+    known = {row[0] for row in db.execute("SELECT code FROM price_history")}
+    record_prices([product for product in products if product.code not in known], time.time())
+
+def get_price_summary(code):
+    """Latest, windowed-low and all-time low/high prices of one product, or None without history"""
+    series = load_price_series(code)
+    if not series:
+        return None
+    return {
+        'last': series.last(),
+        'window_low': series.low_since(time.time() - PRICE_LOW_WINDOW_DAYS * 86400),
+        'low': series.low,
+        'high': series.high,
+        'points': len(series),
+    }
+
+def count_price_history():
+    """Number of products with a price history and total stored points (used by /status)"""
+    db = get_state_db()
+    series, size = db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(timestamps)), 0) FROM price_history").fetchone()
+    return series, size // 8
+
+def format_price_value(value):
+    """Render a numeric price the way SHEIN formats it"""
+    return f"₹{value:,.0f}" if value == int(value) else f"₹{value:,.2f}"
+
+# --- WATCHES ---
+
+@dataclass(frozen=True, slots=True)
+class Watch:
+    """One catalog listing to poll, the pin codes to check its products for and the chat to alert"""
+    name: str
+    category: str
+    query: str = ''
+    facets: str = ''
+    pin_codes: tuple = ()
+    chat_id: str = CHAT_ID
+    interval: float = 5
+    sizes: tuple = ()
+    
+    @classmethod
+    def from_config(cls, data):
+        """Build a Watch from a WATCHES / WATCHES_FILE entry"""
+        data = dict(data)
+        data['pin_codes'] = tuple(data.get('pin_codes') or MONITOR_PIN_CODES)
+        data['chat_id'] = str(data.get('chat_id') or CHAT_ID)
+        data['sizes'] = tuple(str(size).upper() for size in data.get('sizes') or ())
+        return cls(**{name: data[name] for name in cls.__dataclass_fields__ if name in data})
+    
+    @property
+    def url(self):
+        return CATALOG_API_BASE_URL + self.category
+    
+    @property
+    def scope(self):
+        """Identifies the listing this watch crawls, whatever the watch is called"""
+        return '|'.join((self.category, self.query, self.facets))
+
+def load_watches():
+    """Read the watch definitions, dropping entries with a missing or duplicate name"""
+    definitions = WATCHES
+    if os.path.exists(WATCHES_FILE):
+        definitions = read_json_file(WATCHES_FILE) or WATCHES
+    watches = []
+    names = set()
+    for data in definitions:
+        if not data.get('name') or not data.get('category') or data['name'] in names:
+            logger.error(f"Skipping invalid or duplicate watch definition: {data}")
+            continue
+        names.add(data['name'])
+        watches.append(Watch.from_config(data))
+    return watches
+
+WATCH_LIST = load_watches()
+DEFAULT_WATCH = WATCH_LIST[0]
+
+def build_catalog_params(watch, page):
+    """Build the catalog API query parameters for a single page of a watch"""
+    return {
+        'fields': 'SITE',
+        'currentPage': str(page),
+        'pageSize': str(CATALOG_PAGE_SIZE),
+        'format': 'json',
+        'query': watch.query,
+        'sortBy': 'relevance',
+        'gridColumns': '5',
+        'facets': watch.facets,
+        'segmentIds': '',
+        'advfilter': 'true',
+        'platform': 'Desktop',
+        'showAdsOnNextPage': 'false',
+        'is_ads_enable_plp': 'true',
+        'displayRatings': 'true',
+        'store': 'shein'
+    }
+
+def conditional_headers(cached_page):
+    """Build If-None-Match/If-Modified-Since headers from a cached page response"""
+    headers = {}
+    if cached_page:
+        if cached_page.get('etag'):
+            headers['if-none-match'] = cached_page['etag']
+        if cached_page.get('last_modified'):
+            headers['if-modified-since'] = cached_page['last_modified']
+    return headers or None
+
+def parse_catalog_page(body):
+    """Decode a catalog page body into (products, pagination)"""
+    page_data = decode_catalog_page(body)
+    return [Product.from_api(raw) for raw in page_data.get('products') or []], page_data.get('pagination') or {}
+
+async def read_catalog_page_response(watch, page, response):
+    """Turn a catalog response into a cached page entry, decoding JSON only when the body changed"""
+    cached_page = CATALOG_PAGE_CACHE.get((watch.name, page))
+    if response.status_code == 304 and cached_page:
+        CATALOG_STATS['not_modified'] += 1
+        return cached_page
+    
+    response.raise_for_status()
+    body = response.content
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    etag = response.headers.get('etag')
+    last_modified = response.headers.get('last-modified')
+    
+    if cached_page and cached_page['digest'] == digest:
+        # Same bytes as last time, reuse the already decoded page
+        CATALOG_STATS['unchanged_pages'] += 1
+        cached_page['etag'] = etag
+        cached_page['last_modified'] = last_modified
+        return cached_page
+    
+    CATALOG_STATS['decoded_pages'] += 1
+    products, pagination = await run_blocking(parse_catalog_page, body)
+    cached_page = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'digest': digest,
+        'products': products,
+        'pagination': pagination,
+    }
+    CATALOG_PAGE_CACHE[(watch.name, page)] = cached_page
+    return cached_page
+
+async def fetch_catalog_page(watch, page=0):
+    """Fetch a single catalog page of a watch from SHEIN API with retry mechanism.
+    
+    Returns the cached page entry ({'digest', 'products', 'pagination', ...}) or None on failure.
+    """
+    params = build_catalog_params(watch, page)
+    retry_delay = 1  # seconds
+    
+    for attempt in range(CATALOG_MAX_RETRIES + 1):
+        if not CATALOG_BREAKER.allow():
+            logger.warning(f"Catalog API circuit breaker is open, skipping {watch.name} page {page}")
+            return None
+        try:
+            started = time.perf_counter()
+            response = await http_get(watch.url, params=params, headers=conditional_headers(CATALOG_PAGE_CACHE.get((watch.name, page))))
+            CATALOG_FETCH_SECONDS.observe(time.perf_counter() - started)
+            cached_page = await read_catalog_page_response(watch, page, response)
+            CATALOG_BREAKER.record_success()
+            return cached_page
+        except httpx.HTTPStatusError as e:
+            CATALOG_BREAKER.record_failure()
+            if e.response.status_code == 403:
+                UPSTREAM_403.inc(label_value='catalog')
+                logger.error(f"Authentication error (403) on attempt {attempt + 1}/{CATALOG_MAX_RETRIES + 1}. Cookies may be expired.")
+                if attempt < CATALOG_MAX_RETRIES and await COOKIE_SESSION.refresh('catalog 403'):
+                    CATALOG_RETRIES.inc()
+                    continue  # Retry straight away with the fresh cookies
+            else:
+                logger.error(f"HTTP error {e.response.status_code}: {e}")
+                return None
+        except Exception as e:
+            CATALOG_BREAKER.record_failure()
+            logger.error(f"Error fetching {watch.name} catalog page {page}: {e}")
+        
+        if attempt < CATALOG_MAX_RETRIES:
+            CATALOG_RETRIES.inc()
+            logger.info(f"Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, CATALOG_RETRY_MAX_DELAY)  # Exponential backoff
+    
+    logger.error(f"Giving up on {watch.name} catalog page {page} after {CATALOG_MAX_RETRIES + 1} attempts.")
+    return None
+
+def catalog_unavailable_message():
+    """User-facing text for a failed catalog fetch"""
+    if CATALOG_BREAKER.state == 'open':
+        return (f"❌ SHEIN is not responding right now, so product checks are paused.\n\n"
+                f"Please try again in about {CATALOG_BREAKER.retry_in():.0f} seconds.")
+    return ("❌ Failed to fetch products. Please try again later.\n\n"
+            "If this error persists, the cookies may have expired and could not be refreshed automatically. "
+            "Run c.py to regenerate cookies.txt.")
+
+def get_total_pages(pagination):
+    """Read the total page count from a catalog response's pagination block"""
+    try:
+        total_pages = int(pagination.get('totalPages', 1))
+    except (TypeError, ValueError):
+        total_pages = 1
+    return max(1, min(total_pages, CATALOG_MAX_PAGES))
+
+def merge_catalog_pages(pages):
+    """Merge catalog pages into one product list, dropping duplicate and code-less products"""
+    products = []
+    seen_codes = set()
+    for page in pages:
+        for product in page['products']:
+            if not product.code or product.code in seen_codes:
+                continue  # Product shifted between pages while we were crawling
+            seen_codes.add(product.code)
+            products.append(product)
+    return products
+
+async def fetch_catalog(watch=DEFAULT_WATCH):
+    """Fetch a watch's full product listing, crawling the remaining pages concurrently.
+    
+    The returned dict carries a 'digest' of the raw page bodies; when it matches the
+    previous sweep the previous (already merged) catalog is returned as is.
+    """
+    first_page = await fetch_catalog_page(watch, 0)
+    if not first_page:
+        return None
+    
+    total_pages = get_total_pages(first_page['pagination'])
+    pages = [first_page]
+    
+    if total_pages > 1:
+        # The first response tells us how many pages exist; fetch the rest in parallel
+        semaphore = asyncio.Semaphore(CATALOG_CONCURRENCY)
+        
+        async def fetch_limited(page):
+            async with semaphore:
+                return await fetch_catalog_page(watch, page)
+        
+        remaining = await asyncio.gather(*(fetch_limited(page) for page in range(1, total_pages)))
+        
+        failed_pages = [page for page, data in zip(range(1, total_pages), remaining) if not data]
+        if failed_pages:
+            # A partial sweep would report every product on the missing pages as out of stock
+            logger.error(f"Failed to fetch {watch.name} catalog pages {failed_pages} of {total_pages}")
+            return None
+        pages.extend(remaining)
+    
+    # Forget pages that no longer exist
+    for key in [key for key in CATALOG_PAGE_CACHE if key[0] == watch.name and key[1] >= total_pages]:
+        del CATALOG_PAGE_CACHE[key]
+    
+    sweep_digest = hashlib.blake2b(''.join(page['digest'] for page in pages).encode('ascii'), digest_size=16).hexdigest()
+    last_sweep = LAST_CATALOG_SWEEP.get(watch.name)
+    if last_sweep and sweep_digest == last_sweep['digest']:
+        return last_sweep['catalog']
+    
+    products = merge_catalog_pages(pages)
+    logger.info(f"Fetched {len(products)} {watch.name} products from {total_pages} catalog pages")
+    
+    catalog = {
+        'products': products,
+        'pagination': first_page['pagination'],
+        'digest': sweep_digest,
+    }
+    LAST_CATALOG_SWEEP[watch.name] = {'digest': sweep_digest, 'catalog': catalog}
+    return catalog
+
+# --- CATALOG SNAPSHOT ---
+
+@dataclass(frozen=True, slots=True)
+class CatalogSnapshot:
+    """Immutable result of one catalog sweep, shared by the monitor and all commands"""
+    generation: int  # bumped whenever the catalog contents change
+    fetched_at: float  # time.monotonic() when the sweep finished
+    products: tuple
+    digest: str = ''
+    
+    @property
+    def age(self):
+        """Seconds since the sweep finished"""
+        return time.monotonic() - self.fetched_at
+
+class CatalogSnapshotStore:
+    """Publishes a watch's latest catalog snapshot and coalesces concurrent refreshes into one sweep"""
+    
+    def __init__(self, watch):
+        self.watch = watch
+        self.current = None
+        self.refresh_task = None
+        self.reused = 0
+        self.refreshes = 0
+        self.coalesced = 0
+    
+    def publish(self, catalog):
+        """Swap in a snapshot for a fetched catalog, keeping the generation when nothing changed"""
+        previous = self.current
+        if previous is not None and previous.digest == catalog['digest']:
+            snapshot = CatalogSnapshot(previous.generation, time.monotonic(), previous.products, previous.digest)
+        else:
+            generation = previous.generation + 1 if previous is not None else 1
+            snapshot = CatalogSnapshot(generation, time.monotonic(), tuple(catalog['products']), catalog['digest'])
+        self.current = snapshot
+        return snapshot
+    
+    async def refresh(self):
+        """Sweep the catalog and publish it; concurrent callers share one sweep"""
+        task = self.refresh_task
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        
+        self.refreshes += 1
+        task = asyncio.ensure_future(self._refresh())
+        self.refresh_task = task
+        task.add_done_callback(self._refresh_done)
+        return await asyncio.shield(task)
+    
+    async def _refresh(self):
+        catalog = await fetch_catalog(self.watch)
+        if not catalog:
+            return None
+        return self.publish(catalog)
+    
+    def _refresh_done(self, task):
+        if self.refresh_task is task:
+            self.refresh_task = None
+    
+    async def get(self, max_age=CATALOG_SNAPSHOT_MAX_AGE):
+        """Return the current snapshot if it is fresh enough, otherwise refresh it first"""
+        snapshot = self.current
+        if snapshot is not None and snapshot.age <= max_age:
+            self.reused += 1
+            return snapshot
+        return await self.refresh()
+
+CATALOG_SNAPSHOTS = {watch.name: CatalogSnapshotStore(watch) for watch in WATCH_LIST}
+
+# --- WATCH SCHEDULER ---
+
+class PollPacer:
+    """Adaptive polling interval for one watch: tightens while changes are seen, backs off when quiet or failing"""
+    
+    def __init__(self, interval):
+        # A watch configured to poll slower than WATCH_QUIET_MAX_INTERVAL keeps its own interval as the quiet ceiling
+        self.quiet_max_interval = max(WATCH_QUIET_MAX_INTERVAL, interval)
+        self.interval = max(interval, WATCH_MIN_INTERVAL)
+        self.change_rate = 0.0  # smoothed fraction of sweeps that found a change
+        self.errors = 0
+    
+    def on_sweep(self, changed):
+        """Adjust the interval after a successful sweep"""
+        self.errors = 0
+        self.interval = min(self.interval, self.quiet_max_interval)  # recovering from an error backoff
+        self.change_rate += WATCH_CHANGE_SMOOTHING * ((1.0 if changed else 0.0) - self.change_rate)
+        if changed:
+            self.interval = max(WATCH_MIN_INTERVAL, self.interval / 2)
+        else:
+            # Back off more slowly while changes were seen recently
+            factor = 1 + (WATCH_BACKOFF_FACTOR - 1) * (1 - self.change_rate)
+            self.interval = min(self.quiet_max_interval, self.interval * factor)
+    
+    def on_error(self):
+        """Back off exponentially after a failed sweep"""
+        self.errors += 1
+        self.interval = min(max(WATCH_MAX_INTERVAL, self.quiet_max_interval), max(self.interval, WATCH_RETRY_DELAY * 2 ** (self.errors - 1)))
+    
+    def next_delay(self):
+        """Seconds until the next sweep, with jitter so watches do not poll in lockstep"""
+        return self.interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+class WatchScheduler:
+    """Sweeps every watch on its own adaptive interval from one task, a few watches at a time"""
+    
+    def __init__(self, watches):
+        self.watches = watches
+        self.pacers = {watch.name: PollPacer(watch.interval) for watch in watches}
+        self.semaphore = asyncio.Semaphore(WATCH_CONCURRENCY)
+        self.due = []  # heap of (due_at, watch index)
+        self.wakeup = asyncio.Event()  # set when a sweep reschedules its watch
+        self.changed = asyncio.Event()  # set when any watch's snapshot generation moved
+        self.generations = {}  # watch name -> last generation seen
+        self.sweeps = {watch.name: 0 for watch in watches}  # successful sweeps per watch
+        self.tasks = set()
+    
+    def schedule(self, index, delay):
+        heapq.heappush(self.due, (time.monotonic() + delay, index))
+        self.wakeup.set()
+    
+    async def run(self):
+        """Scheduler loop, runs for the lifetime of the bot"""
+        for index in range(len(self.watches)):
+            self.schedule(index, 0)
+        while True:
+            if self.due:
+                due_at, index = self.due[0]
+                delay = due_at - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self.due)
+                    await self.semaphore.acquire()
+                    task = asyncio.ensure_future(self.sweep(index))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    continue
+            else:
+                delay = None
+            # Sleep until the earliest watch is due or a finished sweep pushes an earlier one
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def sweep(self, index):
+        """Refresh one watch's snapshot, adapt its interval and put it back on the schedule"""
+        watch = self.watches[index]
+        pacer = self.pacers[watch.name]
+        snapshot = None
+        try:
+            snapshot = await CATALOG_SNAPSHOTS[watch.name].refresh()
+        except Exception as e:
+            logger.error(f"Error sweeping watch {watch.name}: {e}")
+        finally:
+            self.semaphore.release()
+        
+        if not snapshot:
+            pacer.on_error()
+            self.schedule(index, pacer.next_delay())
+            return
+        MONITOR_STATS['ticks'] += 1
+        self.sweeps[watch.name] += 1
+        changed = self.generations.get(watch.name) != snapshot.generation
+        pacer.on_sweep(changed)
+        self.schedule(index, pacer.next_delay())
+        if not changed:
+            # Nothing changed upstream, no need to diff, persist or alert
+            MONITOR_STATS['skipped_ticks'] += 1
+            if STOCK_TRACKER.missing:
+                # ...but the sweep still counts towards confirming missing products as out of stock
+                self.changed.set()
+            return
+        self.generations[watch.name] = snapshot.generation
+        self.changed.set()
+
+WATCH_SCHEDULER = WatchScheduler(WATCH_LIST)
+
+def merge_watch_snapshots(snapshots):
+    """Union of all watches' products (deduplicated by code) and which watches list each code"""
+    products = []
+    product_watches = {}
+    for watch, snapshot in zip(WATCH_LIST, snapshots):
+        for product in snapshot.products:
+            watches = product_watches.get(product.code)
+            if watches is None:
+                product_watches[product.code] = [watch]
+                products.append(product)
+            elif watch not in watches:
+                watches.append(watch)
+    return products, product_watches
+
+def alert_targets(watches):
+    """Map each chat to alert to the pin codes of its watches that list the product"""
+    targets = {}
+    for watch in watches:
+        pin_codes = targets.setdefault(watch.chat_id, [])
+        pin_codes.extend(pin for pin in watch.pin_codes if pin not in pin_codes)
+    return targets
+
+# --- RESULT SESSIONS ---
+
+class ResultSession:
+    """Numbered product list shown to a chat by /n or /products, plus the pin codes it was checked for"""
+    __slots__ = ('products', 'pin_codes', 'expires_at')
+    
+    def __init__(self, products, pin_codes, ttl):
+        self.products = products  # list that /n appends to while it streams, or a snapshot tuple
+        self.pin_codes = tuple(pin_codes)
+        self.expires_at = time.monotonic() + ttl
+    
+    def product(self, number):
+        """Return the product shown as #number, or None"""
+        try:
+            index = int(number) - 1
+        except (TypeError, ValueError):
+            return None
+        if 0 <= index < len(self.products):
+            return self.products[index]
+        return None
+
+class ResultSessionStore:
+    """LRU/TTL store of result sessions keyed by (chat, user), with the chat's latest as a fallback"""
+    
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sessions = OrderedDict()  # (chat_id, user_id or None) -> ResultSession
+    
+    def start(self, chat_id, user_id, products, pin_codes):
+        """Open a new session for a user, replacing their previous one and the chat's latest"""
+        session = ResultSession(products, pin_codes, self.ttl)
+        for key in ((chat_id, user_id), (chat_id, None)):
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_size:
+            self.sessions.popitem(last=False)
+        return session
+    
+    def get(self, chat_id, user_id):
+        """Return the user's own session in this chat, else the chat's latest one"""
+        now = time.monotonic()
+        for key in ((chat_id, user_id), (chat_id, None)):
+            session = self.sessions.get(key)
+            if session is None:
+                continue
+            if session.expires_at <= now:
+                del self.sessions[key]
+                continue
+            self.sessions.move_to_end(key)
+            return session
+        return None
+
+RESULT_SESSIONS = ResultSessionStore(RESULT_SESSION_TTL, RESULT_SESSION_MAX)
+
+def effective_user_id(update):
+    """User id of an update, or None for channel posts"""
+    return update.effective_user.id if update.effective_user else None
+
+async def check_delivery_availability(product_code, pin_code):
+    """Check delivery availability for a product to a specific pin code"""
+    params = {
+        'productCode': product_code,
+        'postalCode': pin_code,
+        'quantity': '1',
+        'IsExchange': 'false'
+    }
+    
+    if not DELIVERY_BREAKER.allow():
+        return None
+    
+    try:
+        async with DELIVERY_SEMAPHORE:
+            await DELIVERY_LIMITER.acquire()
+            started = time.perf_counter()
+            response = await http_get(DELIVERY_API_URL, params=params)
+            DELIVERY_CHECK_SECONDS.observe(time.perf_counter() - started)
+        if response.status_code in (403, 429):
+            DELIVERY_LIMITER.on_throttle()
+            if response.status_code == 403:
+                UPSTREAM_403.inc(label_value='delivery')
+                COOKIE_SESSION.start_refresh('delivery 403')
+        else:
+            DELIVERY_LIMITER.on_success()
+        response.raise_for_status()
+        data = json_loads(response.content)
+        DELIVERY_BREAKER.record_success()
+        return data
+    except Exception as e:
+        DELIVERY_BREAKER.record_failure()
+        logger.error(f"Error checking delivery for {pin_code}: {e}")
+        return None
+
+def unavailable_delivery_info(reason, failed=False):
+    """Delivery info for a product that can't be delivered (or couldn't be checked)"""
+    return {
+        'serviceable': False,
+        'delivery_method': 'Unknown',
+        'cod_eligible': False,
+        'reason': reason,
+        'failed': failed
+    }
+
+def parse_delivery_response(delivery_data):
+    """Turn a delivery API response into a delivery info dict"""
+    if not delivery_data:
+        return unavailable_delivery_info('API error', failed=True)
+    
+    status = delivery_data.get('status', {})
+    status_code = status.get('statusCode', -1)
+    if status_code != 0:
+        return unavailable_delivery_info('Failed to check delivery', failed=True)
+    
+    product_details = delivery_data.get('productDetails', [])
+    if not product_details:
+        return unavailable_delivery_info('No delivery information available')
+    
+    detail = product_details[0]
+    return {
+        'serviceable': detail.get('servicability', False),
+        'delivery_method': detail.get('deliveryMethod', 'Unknown'),
+        'cod_eligible': detail.get('codEligible', False),
+        'reason': detail.get('reasonForNotServiceability', ''),
+        'failed': False
+    }
+
+async def fetch_delivery_info(product_code, pin_code):
+    """Check delivery for one (product, pin) pair against the API, bypassing the cache"""
+    try:
+        delivery_data = await check_delivery_availability(product_code, pin_code)
+        return parse_delivery_response(delivery_data)
+    except Exception as e:
+        logger.error(f"Error processing delivery for {pin_code}: {e}")
+        return unavailable_delivery_info('Processing error', failed=True)
+
+async def get_delivery_info(product_code, pin_code):
+    """Check delivery for one (product, pin) pair, answering from the cache when possible"""
+    return await DELIVERY_CACHE.get(
+        (product_code, pin_code),
+        lambda: fetch_delivery_info(product_code, pin_code)
+    )
+
+class DeliveryMatrix:
+    """Delivery results for a product × pin code matrix, filled in as checks complete"""
+    
+    def __init__(self, product_codes, pin_codes):
+        self.product_codes = list(dict.fromkeys(product_codes))
+        self.pin_codes = list(dict.fromkeys(pin_codes))
+        self.results = {code: {} for code in self.product_codes}
+        self.completed = 0
+    
+    @property
+    def total(self):
+        return len(self.product_codes) * len(self.pin_codes)
+    
+    def add(self, product_code, pin_code, info):
+        """Record one result. Returns True once the product's row is complete."""
+        row = self.results[product_code]
+        if pin_code not in row:
+            self.completed += 1
+        row[pin_code] = info
+        return len(row) == len(self.pin_codes)
+    
+    def row(self, product_code):
+        """Delivery info for one product as {pin_code: info}, in pin code order"""
+        row = self.results.get(product_code, {})
+        return {pin_code: row[pin_code] for pin_code in self.pin_codes if pin_code in row}
+    
+    def is_deliverable(self, product_code):
+        """True if the product can be delivered to any of the pin codes"""
+        return any(info['serviceable'] for info in self.results.get(product_code, {}).values())
+
+async def iter_delivery_matrix(product_codes, pin_codes):
+    """Check every (product, pin) pair and yield (product_code, pin_code, info) as each completes.
+    
+    Pairs are fanned out to a fixed pool of workers; the global DELIVERY_SEMAPHORE and
+    adaptive DELIVERY_LIMITER bound what actually reaches the API, and cached pairs
+    come back without a call.
+    """
+    pairs = [(code, pin_code) for code in dict.fromkeys(product_codes) for pin_code in dict.fromkeys(pin_codes)]
+    if not pairs:
+        return
+    
+    pending = iter(pairs)
+    results = asyncio.Queue()
+    
+    async def worker():
+        for product_code, pin_code in pending:
+            try:
+                info = await get_delivery_info(product_code, pin_code)
+            except Exception as e:
+                logger.error(f"Error checking delivery for {product_code} to {pin_code}: {e}")
+                info = unavailable_delivery_info('Processing error', failed=True)
+            await results.put((product_code, pin_code, info))
+    
+    workers = [asyncio.create_task(worker()) for _ in range(min(len(pairs), DELIVERY_MAX_CONCURRENCY))]
+    try:
+        for _ in range(len(pairs)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+async def check_delivery_matrix(product_codes, pin_codes):
+    """Check delivery for every product × pin code pair and return the filled DeliveryMatrix"""
+    matrix = DeliveryMatrix(product_codes, pin_codes)
+    async for product_code, pin_code, info in iter_delivery_matrix(matrix.product_codes, matrix.pin_codes):
+        matrix.add(product_code, pin_code, info)
+    return matrix
 
+async def check_delivery_for_pins(product_code, pin_codes):
+    """Check delivery availability for a list of pin codes"""
+    matrix = await check_delivery_matrix([product_code], pin_codes)
+    return matrix.row(product_code)
 
-# Global variables to store data
-PRODUCTS_CACHE = {}
-PREVIOUS_CATALOG = {}
+async def check_delivery_for_all_pins(product_code):
+    """Check delivery availability for all MONITOR_PIN_CODES (used for alerts)"""
+    return await check_delivery_for_pins(product_code, MONITOR_PIN_CODES)
 
-# Thread pool for concurrent requests
-executor = ThreadPoolExecutor(max_workers=10)
+# --- VARIANT AVAILABILITY ---
 
-# --- UTILITY FUNCTIONS (NO CHANGES NEEDED) ---
+# Detail lookup priorities, lowest first
+VARIANT_PRIORITY_NEW = 0  # new and restocked products
+VARIANT_PRIORITY_CHANGED = 1  # products whose listing changed
+VARIANT_PRIORITY_REFRESH = 2  # periodic re-check of unchanged products
 
-def load_product_codes():
-    """Load existing product codes from file"""
-    if not os.path.exists(PRODUCT_CODES_FILE):
-        return set()
-    with open(PRODUCT_CODES_FILE, 'r') as f:
-        return set(line.strip() for line in f)
+Variant = namedtuple('Variant', ['code', 'size', 'color', 'in_stock'])
 
-def save_product_codes(codes):
-    """Save product codes to file"""
-    with open(PRODUCT_CODES_FILE, 'w') as f:
-        for code in codes:
-            f.write(f"{code}\n")
+def parse_product_variants(body):
+    """Decode a product detail response into a tuple of Variants (one per 'variantOptions' entry)"""
+    raw = json_loads(body)
+    color = product_color(raw)
+    variants = []
+    for option in raw.get('variantOptions') or []:
+        qualifiers = {qualifier.get('qualifier'): qualifier.get('value') for qualifier in option.get('variantOptionQualifiers') or []}
+        status = (option.get('stock') or {}).get('stockLevelStatus') or ''
+        variants.append(Variant(
+            code=option.get('code') or '',
+            size=str(qualifiers.get('size') or '').upper(),
+            color=qualifiers.get('color') or color,
+            in_stock=status not in ('', 'outOfStock'),
+        ))
+    return tuple(variants)
 
-def load_product_details():
-    """Load product details from file"""
-    if not os.path.exists(PRODUCT_DETAILS_FILE):
-        return {}
+async def fetch_product_variants(product_code):
+    """Look up one product's variants on the detail API (None on failure)"""
+    if not DETAIL_BREAKER.allow():
+        return None
     try:
-        with open(PRODUCT_DETAILS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+        await VARIANT_LIMITER.acquire()
+        started = time.perf_counter()
+        response = await http_get(PRODUCT_DETAIL_API_URL + product_code)
+        DETAIL_FETCH_SECONDS.observe(time.perf_counter() - started)
+        if response.status_code == 403:
+            UPSTREAM_403.inc(label_value='detail')
+            COOKIE_SESSION.start_refresh('detail 403')
+        response.raise_for_status()
+        variants = await run_blocking(parse_product_variants, response.content)
+        DETAIL_BREAKER.record_success()
+        return variants
+    except Exception as e:
+        DETAIL_BREAKER.record_failure()
+        logger.error(f"Error fetching variants for {product_code}: {e}")
+        return None
 
-def save_product_details(details):
-    """Save product details to file"""
-    with open(PRODUCT_DETAILS_FILE, 'w') as f:
-        json.dump(details, f, indent=2)
+async def get_product_variants(product_code, fresh=False):
+    """Variants of one product, answered from the cache unless fresh is set"""
+    if fresh:
+        VARIANT_CACHE.invalidate(product_code)
+    return await VARIANT_CACHE.get(product_code, lambda: fetch_product_variants(product_code))
 
-def load_out_of_stock():
-    """Load out of stock products from file"""
-    if not os.path.exists(OUT_OF_STOCK_FILE):
-        return set()
-    with open(OUT_OF_STOCK_FILE, 'r') as f:
-        return set(line.strip() for line in f)
+def sizes_in_stock(variants):
+    return frozenset(variant.size for variant in variants if variant.in_stock and variant.size)
 
-def save_out_of_stock(codes):
-    """Save out of stock products to file"""
-    with open(OUT_OF_STOCK_FILE, 'w') as f:
+class VariantTracker:
+    """Keeps per-size stock of tracked products current through product detail lookups.
+    
+    Lookups wait in a priority queue (new and restocked products first, then changed
+    ones, then periodic refreshes) that a fixed pool of workers drains behind
+    VARIANT_LIMITER. When sizes a watch asked for come back, its chat gets a digest line.
+    """
+    
+    def __init__(self, workers, queue_max):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.heap = []  # (priority, sequence, code)
+        self.queued = {}  # code -> best priority waiting in the heap (older heap entries are stale)
+        self.sequence = 0
+        self.ready = asyncio.Event()
+        self.listed = {}  # code -> watches listing it, from the monitor's last pass
+        self.sizes = {}  # code -> sizes in stock at the last successful lookup
+        self.checked_at = {}  # code -> monotonic time of the last successful lookup
+        self.tasks = set()  # worker tasks
+        self.stats = {'lookups': 0, 'failed': 0, 'skipped': 0, 'alerts': 0}
+    
+    @staticmethod
+    def tracks(watches):
+        return VARIANT_TRACKING or any(watch.sizes for watch in watches)
+    
+    def submit(self, codes, priority):
+        """Queue lookups for the given codes, upgrading codes already queued at a lower priority"""
         for code in codes:
-            f.write(f"{code}\n")
+            queued = self.queued.get(code)
+            if queued is not None and queued <= priority:
+                continue
+            if queued is None and priority >= VARIANT_PRIORITY_REFRESH and len(self.queued) >= self.queue_max:
+                self.stats['skipped'] += 1
+                continue
+            self.queued[code] = priority
+            self.sequence += 1
+            heapq.heappush(self.heap, (priority, self.sequence, code))
+        if self.heap:
+            self.ready.set()
+    
+    def observe(self, product_watches, new_codes, changed_codes):
+        """Queue the tracked products of one monitor pass"""
+        self.listed = product_watches
+        self.submit([code for code in new_codes if self.tracks(product_watches.get(code, ()))], VARIANT_PRIORITY_NEW)
+        self.submit([code for code in changed_codes if self.tracks(product_watches.get(code, ()))], VARIANT_PRIORITY_CHANGED)
+    
+    def submit_stale(self):
+        """Queue every tracked product whose last lookup is older than VARIANT_REFRESH_INTERVAL"""
+        for code in [code for code in self.sizes if code not in self.listed]:
+            # No longer listed: forget it, a comeback is looked up as a restock
+            del self.sizes[code]
+            self.checked_at.pop(code, None)
+        cutoff = time.monotonic() - VARIANT_REFRESH_INTERVAL
+        self.submit([code for code, watches in self.listed.items()
+                     if self.checked_at.get(code, 0) < cutoff and self.tracks(watches)], VARIANT_PRIORITY_REFRESH)
+    
+    async def next_code(self):
+        while True:
+            while self.heap:
+                priority, _, code = heapq.heappop(self.heap)
+                if self.queued.get(code) == priority:
+                    del self.queued[code]
+                    return code, priority
+            self.ready.clear()
+            await self.ready.wait()
+    
+    async def worker(self):
+        while True:
+            code, priority = await self.next_code()
+            try:
+                await self.resolve(code, fresh=priority < VARIANT_PRIORITY_REFRESH)
+            except Exception as e:
+                logger.error(f"Error resolving variants for {code}: {e}")
+    
+    async def resolve(self, code, fresh=False):
+        """Look up one product and alert the chats whose sizes just came back"""
+        variants = await get_product_variants(code, fresh=fresh)
+        self.stats['lookups'] += 1
+        if variants is None:
+            self.stats['failed'] += 1
+            return
+        sizes = sizes_in_stock(variants)
+        previous = self.sizes.get(code)
+        self.sizes[code] = sizes
+        self.checked_at[code] = time.monotonic()
+        if previous is None:
+            return  # First lookup is the baseline
+        back = sizes - previous
+        watches = self.listed.get(code, ())
+        if not back or not any(watch.sizes for watch in watches):
+            return
+        product = PREVIOUS_CATALOG.get(code) or Product(code=code)
+        lines = {}  # (chat_id, text), so watches sharing a chat send one line
+        for watch in watches:
+            wanted = sorted(back.intersection(watch.sizes))
+            if wanted:
+                text = (f"• <a href='https://www.sheinindia.in/p/{html.escape(code)}'>{html.escape(product.name)}</a> "
+                        f"({html.escape(code)}): {html.escape(', '.join(wanted))}")
+                lines[(watch.chat_id, text)] = None
+        if lines:
+            self.stats['alerts'] += len(lines)
+            await enqueue_alerts([(chat_id, {'digest': 'sizes', 'text': text}) for chat_id, text in lines])
+    
+    async def run(self):
+        """Start the worker pool and queue periodic refreshes, for the lifetime of the bot"""
+        for _ in range(self.workers):
+            task = asyncio.ensure_future(self.worker())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        while True:
+            await asyncio.sleep(min(60, VARIANT_REFRESH_INTERVAL))
+            self.submit_stale()
+    
+    async def stop(self):
+        """Cancel the worker pool"""
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-def load_notified_out_of_stock():
-    """Load already notified out of stock products"""
-    if not os.path.exists(NOTIFIED_OUT_OF_STOCK_FILE):
-        return set()
-    with open(NOTIFIED_OUT_OF_STOCK_FILE, 'r') as f:
-        return set(line.strip() for line in f)
+DETAIL_BREAKER = CircuitBreaker('Product detail API', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+VARIANT_LIMITER = TokenBucket(VARIANT_RATE, VARIANT_RATE)
+VARIANT_CACHE = TTLCache(VARIANT_CACHE_TTL, VARIANT_CACHE_NEGATIVE_TTL, VARIANT_CACHE_MAX_SIZE)
+VARIANT_TRACKER = VariantTracker(VARIANT_WORKERS, VARIANT_QUEUE_MAX)
 
-def save_notified_out_of_stock(codes):
-    """Save already notified out of stock products"""
-    with open(NOTIFIED_OUT_OF_STOCK_FILE, 'w') as f:
-        for code in codes:
-            f.write(f"{code}\n")
+def render_variant_summary(variants):
+    """Size availability line for /checkdelivery (empty without variants)"""
+    if not variants:
+        return ''
+    in_stock = list(dict.fromkeys(variant.size for variant in variants if variant.in_stock and variant.size))
+    sold_out = [size for size in dict.fromkeys(variant.size for variant in variants if variant.size) if size not in in_stock]
+    line = f"Sizes: {html.escape(', '.join(in_stock)) or 'none in stock'}"
+    if sold_out:
+        line += f" (sold out: {html.escape(', '.join(sold_out))})"
+    return line + "\n"
 
-def load_notified_new_products():
-    """Load already notified new products"""
-    if not os.path.exists(NOTIFIED_NEW_PRODUCTS_FILE):
-        return set()
-    with open(NOTIFIED_NEW_PRODUCTS_FILE, 'r') as f:
-        return set(line.strip() for line in f)
+# --- REVISED HELPER FUNCTION ---
+# Static parts of a product message: everything above the delivery section, and the link below it
+ProductCard = namedtuple('ProductCard', ['body', 'link'])
 
-def save_notified_new_products(codes):
-    """Save already notified new products"""
-    with open(NOTIFIED_NEW_PRODUCTS_FILE, 'w') as f:
-        for code in codes:
-            f.write(f"{code}\n")
+def render_price(product):
+    """Price line, with the original price struck through when an offer applies"""
+    price = product.price or 'Price not available'
+    if product.offer_price and product.offer_price != price:
+        return f"Price: <s>{html.escape(price)}</s> {html.escape(product.offer_price)}\n"
+    return f"Price: {html.escape(price)}\n"
 
-def load_notified_price_changes():
-    """Load already notified price changes"""
-    if not os.path.exists(NOTIFIED_PRICE_CHANGES_FILE):
-        return {}
-    try:
-        with open(NOTIFIED_PRICE_CHANGES_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+@lru_cache(maxsize=PRODUCT_CARD_CACHE_SIZE)
+def product_card(product):
+    """Render the HTML-escaped static parts of a product message once per product version"""
+    parts = [f"<b>{html.escape(product.name)}</b>\n", f"Code: {html.escape(product.code)}\n"]
+    if product.color:
+        parts.append(f"Color: {html.escape(product.color.title())}\n")
+    parts.append(render_price(product))
+    if product.rating > 0:
+        parts.append(f"Rating: {product.rating} ({product.rating_count} reviews)\n")
+    if product.tags:
+        parts.append(f"Tags: {html.escape(', '.join(product.tags))}\n")
+    
+    link = f"\n<a href='{html.escape('https://www.sheinindia.in' + product.url)}'>🔗 View on SHEIN</a>"
+    return ProductCard(''.join(parts), link)
 
-def save_notified_price_changes(data):
-    """Save already notified price changes"""
-    with open(NOTIFIED_PRICE_CHANGES_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+@lru_cache(maxsize=4096)
+def render_pin_status(pin_code, serviceable, delivery_method, cod_eligible, reason):
+    """Delivery status block for one pin code"""
+    parts = [f"\n📍 <b>{html.escape(pin_code)}:</b>\n", f"Serviceable: {'✅ Yes' if serviceable else '❌ No'}\n"]
+    if serviceable:
+        parts.append(f"Delivery Method: {html.escape(str(delivery_method))}\n")
+        parts.append(f"COD Available: {'✅ Yes' if cod_eligible else '❌ No'}\n")
+    elif reason:
+        parts.append(f"Reason: {html.escape(str(reason))}\n")
+    return ''.join(parts)
 
-def fetch_catalog():
-    """Fetch product catalog from SHEIN API with retry mechanism"""
-    params = {
-        'fields': 'SITE',
-        'currentPage': '0',
-        'pageSize': '45',
-        'format': 'json',
-        'query': ':relevance:genderfilter:Men',
-        'sortBy': 'relevance',
-        'gridColumns': '5',
-        'facets': 'genderfilter:Men',
-        'segmentIds': '',
-        'advfilter': 'true',
-        'platform': 'Desktop',
-        'showAdsOnNextPage': 'false',
-        'is_ads_enable_plp': 'true',
-        'displayRatings': 'true',
-        'store': 'shein'
-    }
+def render_price_summary(summary):
+    """Price history line for /checkdelivery (empty without history)"""
+    if not summary:
+        return ''
+    window_low = summary['window_low'] or summary['last']
+    return (f"Price: {format_price_value(summary['last'])} · {PRICE_LOW_WINDOW_DAYS}-day low {format_price_value(window_low)} · "
+            f"all-time low {format_price_value(summary['low'])}\n")
+
+def render_delivery_section(delivery_info):
+    """Delivery status section for a {pin_code: delivery info} dict"""
+    parts = ["\n<b>🚚 Delivery Status:</b>\n"]
+    for pin_code, info in delivery_info.items():
+        parts.append(render_pin_status(pin_code, info['serviceable'], info['delivery_method'], info['cod_eligible'], info['reason']))
+    return ''.join(parts)
+
+def format_product_info(product, index=None, delivery_info=None):
+    """Format product information for display, reusing the product's pre-rendered card"""
+    card = product_card(product)
     
-    max_retries = 100000000000000000
-    retry_delay = 1  # seconds
+    # Add index if provided
+    # The index here is i+1 from the loops, representing the product number
+    header = f"📦 <b>Product #{index + 1}</b>\n\n" if index is not None else ''
     
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(CATALOG_API_URL, params=params, headers=HEADERS, cookies=COOKIES, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 403:
-                logger.error(f"Authentication error (403) on attempt {attempt + 1}/{max_retries}. Cookies may be expired.")
-                if attempt < max_retries - 1:
-                    logger.info(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    logger.error("Max retries reached. Please update the cookies in the script.")
-                    return None
-            else:
-                logger.error(f"HTTP error {e.response.status_code}: {e}")
-                return None
-        except Exception as e:
-            logger.error(f"Error fetching catalog: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                return None
+    # Only the delivery section is rendered per message
+    delivery = render_delivery_section(delivery_info) if delivery_info else ''
     
-    return None
+    return ''.join((header, card.body, delivery, card.link)), product.image_url
 
-def check_delivery_availability(product_code, pin_code):
-    """Check delivery availability for a product to a specific pin code"""
-    params = {
-        'productCode': product_code,
-        'postalCode': pin_code,
-        'quantity': '1',
-        'IsExchange': 'false'
-    }
-    
-    try:
-        response = requests.get(DELIVERY_API_URL, params=params, headers=HEADERS, cookies=COOKIES, timeout=10)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logger.error(f"Error checking delivery for {pin_code}: {e}")
-        return None
+# --- CATALOG DIFF ---
 
-async def check_delivery_for_pins(product_code, pin_codes):
-    """Check delivery availability for a list of pin codes"""
-    delivery_info = {}
+# Change event kinds produced by CatalogDiff
+EVENT_ADDED = 'added'
+EVENT_REMOVED = 'removed'
+EVENT_PRICE_CHANGED = 'price_changed'
+EVENT_OFFER_CHANGED = 'offer_changed'
+EVENT_BACK_IN_STOCK = 'back_in_stock'
+EVENT_SOLD_OUT = 'sold_out'
+
+ChangeEvent = namedtuple('ChangeEvent', ['kind', 'code', 'product', 'old', 'new'])
+
+def product_fingerprint_fields(product):
+    """Extract the fields whose changes we alert on: (price, offer price, stock, rating)"""
+    return (product.price, product.offer_price, product.stock, product.rating)
+
+def fingerprint(fields):
+    """Stable 64-bit hash of a product's fingerprint fields"""
+    raw = '\x1f'.join(str(field) for field in fields).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'big')
+
+class CatalogDiff:
+    """Turns successive catalog sweeps into typed change events.
     
-    # Create tasks for concurrent execution
-    loop = asyncio.get_event_loop()
-    tasks = []
+    Keeps a hash plus the handful of fingerprint fields per product code, so an
+    unchanged product costs one hash comparison and is never reprocessed.
+    """
     
-    for pin_code in pin_codes:
-        task = loop.run_in_executor(executor, check_delivery_availability, product_code, pin_code)
-        tasks.append((pin_code, task))
+    def __init__(self):
+        self.fingerprints = {}  # code -> fingerprint hash (None if the fields are unknown)
+        self.fields = {}  # code -> fingerprint fields used to describe a change
+        self.removed = set()  # codes that dropped out of the catalog
     
-    # Wait for all tasks to complete
-    for pin_code, task in tasks:
-        try:
-            delivery_data = await task
-            if delivery_data:
-                status = delivery_data.get('status', {})
-                status_code = status.get('statusCode', -1)
-                
-                if status_code == 0:
-                    product_details = delivery_data.get('productDetails', [])
-                    if product_details:
-                        detail = product_details[0]
-                        delivery_info[pin_code] = {
-                            'serviceable': detail.get('servicability', False),
-                            'delivery_method': detail.get('deliveryMethod', 'Unknown'),
-                            'cod_eligible': detail.get('codEligible', False),
-                            'reason': detail.get('reasonForNotServiceability', '')
-                        }
-                    else:
-                        delivery_info[pin_code] = {
-                            'serviceable': False,
-                            'delivery_method': 'Unknown',
-                            'cod_eligible': False,
-                            'reason': 'No delivery information available'
-                        }
+    def seed(self, products, known_codes=(), removed_codes=()):
+        """Load the last known state without producing events"""
+        for code, product in products.items():
+            fields = product_fingerprint_fields(product)
+            self.fingerprints[code] = fingerprint(fields)
+            self.fields[code] = fields
+        for code in known_codes:
+            self.fingerprints.setdefault(code, None)
+        for code in removed_codes:
+            self.fingerprints.pop(code, None)
+            self.fields.pop(code, None)
+            self.removed.add(code)
+    
+    def forget(self, codes):
+        """Drop every trace of the given codes, so they come back as new products"""
+        for code in codes:
+            self.fingerprints.pop(code, None)
+            self.fields.pop(code, None)
+            self.removed.discard(code)
+    
+    def diff(self, current_products):
+        """Compare a catalog sweep with the previous one.
+        
+        Returns (events, changed) where changed maps code -> product for every
+        product that is new or whose fingerprint changed.
+        """
+        events = []
+        changed = {}
+        current_codes = set()
+        
+        for product in current_products:
+            code = product.code
+            if not code:
+                continue
+            current_codes.add(code)
+            fields = product_fingerprint_fields(product)
+            digest = fingerprint(fields)
+            
+            if code not in self.fingerprints:
+                if code in self.removed:
+                    self.removed.discard(code)
+                    # Listed again, but possibly still flagged out of stock (or never delisted, after a restart)
+                    kind = EVENT_SOLD_OUT if fields[2] == 'outOfStock' else EVENT_BACK_IN_STOCK
+                    events.append(ChangeEvent(kind, code, product, None, fields[2]))
                 else:
-                    delivery_info[pin_code] = {
-                        'serviceable': False,
-                        'delivery_method': 'Unknown',
-                        'cod_eligible': False,
-                        'reason': 'Failed to check delivery'
-                    }
+                    events.append(ChangeEvent(EVENT_ADDED, code, product, None, None))
+            elif self.fingerprints[code] != digest:
+                old_fields = self.fields.get(code)
+                if old_fields is not None:
+                    events.extend(self._field_changes(code, product, old_fields, fields))
             else:
-                delivery_info[pin_code] = {
-                    'serviceable': False,
-                    'delivery_method': 'Unknown',
-                    'cod_eligible': False,
-                    'reason': 'API error'
-                }
-        except Exception as e:
-            logger.error(f"Error processing delivery for {pin_code}: {e}")
-            delivery_info[pin_code] = {
-                'serviceable': False,
-                'delivery_method': 'Unknown',
-                'cod_eligible': False,
-                'reason': 'Processing error'
-            }
+                continue  # Unchanged
+            
+            self.fingerprints[code] = digest
+            self.fields[code] = fields
+            changed[code] = product
+        
+        for code in self.fingerprints.keys() - current_codes:
+            del self.fingerprints[code]
+            self.fields.pop(code, None)
+            self.removed.add(code)
+            events.append(ChangeEvent(EVENT_REMOVED, code, None, None, None))
+        
+        return events, changed
     
-    return delivery_info
+    @staticmethod
+    def _field_changes(code, product, old_fields, new_fields):
+        """Describe which fingerprint fields changed for one product"""
+        old_price, old_offer, old_stock, _ = old_fields
+        new_price, new_offer, new_stock, _ = new_fields
+        events = []
+        if old_price != new_price:
+            events.append(ChangeEvent(EVENT_PRICE_CHANGED, code, product, old_price, new_price))
+        if old_offer != new_offer:
+            events.append(ChangeEvent(EVENT_OFFER_CHANGED, code, product, old_offer, new_offer))
+        if old_stock == 'outOfStock' and new_stock != 'outOfStock':
+            events.append(ChangeEvent(EVENT_BACK_IN_STOCK, code, product, old_stock, new_stock))
+        elif new_stock == 'outOfStock' and old_stock != 'outOfStock':
+            events.append(ChangeEvent(EVENT_SOLD_OUT, code, product, old_stock, new_stock))
+        return events
 
-async def check_delivery_for_all_pins(product_code):
-    """Check delivery availability for all MONITOR_PIN_CODES (used for alerts)"""
-    return await check_delivery_for_pins(product_code, MONITOR_PIN_CODES)
+CATALOG_DIFF = CatalogDiff()
 
-# --- REVISED HELPER FUNCTION ---
-def format_product_info(product, index=None, delivery_info=None):
-    """Format product information for display"""
-    name = product.get('name', 'Unknown Product')
-    code = product.get('code', 'Unknown Code')
-    price = product.get('price', {}).get('formattedValue', 'Price not available')
-    offer_price = product.get('offerPrice', {}).get('formattedValue', '')
-    rating = product.get('averageRating', 0)
-    rating_count = product.get('ratingCount', 0)
-    url = f"https://www.sheinindia.in{product.get('url', '')}"
-    
-    # Get color from the product data
-    color_group = product.get('fnlColorVariantData', {}).get('colorGroup', '')
-    color = color_group.split('_')[-1] if '_' in color_group else color_group
-    
-    # Get primary image - try different image formats
-    images = product.get('images', [])
-    image_url = ''
-    
-    if images:
-        # Try to get the best quality image
-        for img in images:
-            if img.get('format') == 'product' and img.get('imageType') == 'PRIMARY':
-                image_url = img.get('url', '')
-                break
-        
-        # If not found, try any other format
-        if not image_url:
-            for img in images:
-                if img.get('url'):
-                    image_url = img.get('url')
-                    break
+# --- STOCK STATE ---
+
+class StockTracker:
+    """Per-product stock state machine: active -> missing -> confirmed out -> restocked.
     
-    # Get tags
-    tags = []
-    category_tags = product.get('tags', {}).get('categoryTags', [])
-    for tag in category_tags:
-        if tag.get('category') == 'SELLING_POINT':
-            tags.append(tag.get('primary', {}).get('name', ''))
+    A product that drops out of the listing only counts as out of stock once
+    STOCK_CONFIRM_SWEEPS further sweeps of the watches that listed it still miss it,
+    so pagination jitter never alerts. A pass only touches the products in its diff
+    events plus the few still waiting for confirmation.
+    """
     
-    # Format message
-    message = ""
+    def __init__(self, confirm_sweeps):
+        self.confirm_sweeps = confirm_sweeps
+        self.states = {}  # code -> state, for every product that is not simply active
+        self.missing = {}  # code -> ({watch name: sweeps of that watch when it went missing}, misses)
     
-    # Add index if provided
-    if index is not None:
-        # The index here is i+1 from the loops, representing the product number
-        message += f"📦 <b>Product #{index + 1}</b>\n\n" 
+    def seed(self, rows, sweeps):
+        """Load stored (code, state, misses) rows; missing products keep counting on every watch"""
+        for code, state, misses in rows:
+            self.states[code] = state
+            if state == STOCK_MISSING:
+                self.missing[code] = ({name: count - misses for name, count in sweeps.items()}, misses)
     
-    message += f"<b>{name}</b>\n"
-    message += f"Code: {code}\n"
+    def state(self, code):
+        return self.states.get(code, STOCK_ACTIVE)
     
-    if color:
-        message += f"Color: {color.title()}\n"
+    def forget(self, codes):
+        """Stop tracking the given codes"""
+        for code in codes:
+            self.states.pop(code, None)
+            self.missing.pop(code, None)
     
-    if offer_price and offer_price != price:
-        message += f"Price: <s>{price}</s> {offer_price}\n"
-    else:
-        message += f"Price: {price}\n"
-    
-    if rating > 0:
-        message += f"Rating: {rating} ({rating_count} reviews)\n"
-    
-    if tags:
-        message += f"Tags: {', '.join(tags)}\n"
-    
-    # Add delivery information if provided
-    if delivery_info:
-        message += f"\n<b>🚚 Delivery Status:</b>\n"
-        for pin_code, info in delivery_info.items():
-            message += f"\n📍 <b>{pin_code}:</b>\n"
-            message += f"Serviceable: {'✅ Yes' if info['serviceable'] else '❌ No'}\n"
-            if info['serviceable']:
-                message += f"Delivery Method: {info['delivery_method']}\n"
-                message += f"COD Available: {'✅ Yes' if info['cod_eligible'] else '❌ No'}\n"
+    def _set(self, changes, code, state, misses=0):
+        if state == STOCK_ACTIVE:
+            self.states.pop(code, None)
+        else:
+            self.states[code] = state
+        if state != STOCK_MISSING:
+            self.missing.pop(code, None)
+        changes[code] = (state, misses)
+    
+    def update(self, events, product_watches, sweeps):
+        """Apply one pass's diff events and the watches' sweep counts.
+        
+        product_watches maps codes to the watches that listed them before this pass
+        (used to know which sweeps confirm a disappearance). Returns (changes, sold_out,
+        restocked): the {code: (state, misses)} transitions to persist, the codes that
+        were just confirmed out of stock and the codes that just came back.
+        """
+        changes = {}
+        sold_out = []
+        restocked = []
+        
+        for event in events:
+            code = event.code
+            state = self.state(code)
+            if event.kind == EVENT_REMOVED:
+                if state in (STOCK_ACTIVE, STOCK_RESTOCKED):
+                    watches = product_watches.get(code) or WATCH_LIST
+                    self.missing[code] = ({watch.name: sweeps.get(watch.name, 0) for watch in watches}, 0)
+                    self._set(changes, code, STOCK_MISSING)
+            elif event.kind == EVENT_SOLD_OUT:
+                # Still listed but flagged out of stock: nothing to debounce
+                if state != STOCK_OUT:
+                    self._set(changes, code, STOCK_OUT)
+                    sold_out.append(code)
+            elif event.kind in (EVENT_ADDED, EVENT_BACK_IN_STOCK):
+                if state == STOCK_MISSING:
+                    # Back before it was confirmed gone: pagination jitter, not a restock
+                    self._set(changes, code, STOCK_ACTIVE)
+                elif state == STOCK_OUT:
+                    self._set(changes, code, STOCK_RESTOCKED)
+                    restocked.append(code)
+        
+        for code, (baseline, misses) in list(self.missing.items()):
+            # Every watch that listed the product has to have swept it again
+            current = min(sweeps.get(name, 0) - count for name, count in baseline.items())
+            if current >= self.confirm_sweeps:
+                self._set(changes, code, STOCK_OUT, current)
+                sold_out.append(code)
+            elif current != misses:
+                self.missing[code] = (baseline, current)
+                changes[code] = (STOCK_MISSING, current)
+        
+        return changes, sold_out, restocked
+
+STOCK_TRACKER = StockTracker(STOCK_CONFIRM_SWEEPS)
+
+# --- NOTIFICATION DISPATCHER ---
+
+def retry_after_seconds(error):
+    """Read the flood-control delay from a RetryAfter error"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+class NotificationDispatcher:
+    """Sends queued Telegram messages from the persistent outbox within Telegram's rate limits.
+    
+    Every chat with due messages gets its own sender task, so one chat's rate limit or
+    flood-control pause never delays the others; all senders share the global rate limit.
+    Within a chat, alerts go out before bulk command output, each in the order queued.
+    """
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.senders = {}  # chat_id -> sender task
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+    
+    def notify(self):
+        """Wake the dispatcher after new messages were queued"""
+        self.wakeup.set()
+    
+    def chat_bucket(self, chat_id):
+        """Return the rate limiter for one chat (groups and channels have negative ids)"""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if str(chat_id).startswith('-'):
+                bucket = TokenBucket(NOTIFY_GROUP_RATE, NOTIFY_GROUP_BURST)
             else:
-                if info['reason']:
-                    message += f"Reason: {info['reason']}\n"
+                bucket = TokenBucket(NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    async def run(self):
+        """Dispatcher loop: start a sender for every chat with due messages, for the lifetime of the bot"""
+        while True:
+            try:
+                self.wakeup.clear()
+                for chat_id in await run_db(load_due_outbox_chats):
+                    if chat_id not in self.senders:
+                        task = asyncio.ensure_future(self.send_chat(chat_id))
+                        self.senders[chat_id] = task
+                        task.add_done_callback(partial(self.sender_done, chat_id))
+                next_due = await run_db(next_outbox_due_time)
+                timeout = 30 if next_due is None else max(0.1, next_due - time.time())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(timeout, 30))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in notification dispatcher: {e}")
+                await asyncio.sleep(5)
+    
+    def sender_done(self, chat_id, task):
+        # Messages queued while the sender was finishing up are picked up by the next pass
+        self.senders.pop(chat_id, None)
+        self.wakeup.set()
+    
+    async def send_chat(self, chat_id):
+        """Send one chat's due messages batch by batch until none are due or one must wait"""
+        try:
+            while True:
+                # Reloaded after every batch, so alerts queued meanwhile go ahead of bulk output
+                rows = await run_db(load_due_outbox, chat_id, NOTIFY_BATCH_SIZE)
+                if not rows:
+                    return
+                kind, batch = group_outbox_rows(rows)[0]
+                if not await self.send_batch(kind, batch):
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending notifications to chat {chat_id}: {e}")
+            await asyncio.sleep(5)
+    
+    async def send_batch(self, kind, rows):
+        """Send one batch of outbox rows as a single API call.
+        
+        Returns False if later messages for the chat must wait.
+        """
+        row_ids = [row[0] for row in rows]
+        chat_id = rows[0][1]
+        attempts = rows[0][3]
+        bucket = self.chat_bucket(chat_id)
+        # Telegram counts every album item as a message
+        messages = len(rows) if kind == 'album' else 1
+        while True:
+            for _ in range(messages):
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+            try:
+                if kind == 'album':
+                    await self.deliver_album(chat_id, [row[2] for row in rows])
+                elif kind == 'digest':
+                    await self.bot.send_message(chat_id=chat_id, text=render_digest([row[2] for row in rows]), parse_mode='HTML')
+                else:
+                    await self.deliver(chat_id, rows[0][2])
+                await run_db(remove_from_outbox, row_ids)
+                self.sent += len(rows)
+                ALERTS_SENT.inc(len(rows), kind)
+                return True
+            except RetryAfter as e:
+                # Flood control: hold this chat back for as long as Telegram asks, then retry
+                delay = retry_after_seconds(e)
+                logger.warning(f"Flood control for chat {chat_id}, waiting {delay:.0f} seconds")
+                bucket.pause(delay)
+            except BadRequest as e:
+                if kind == 'album' and len(rows) > 1:
+                    # One bad image fails the whole album, send the items one by one instead
+                    logger.warning(f"Sending album to chat {chat_id} failed, sending items separately: {e}")
+                    for row in rows:
+                        if not await self.send_batch('single', [row]):
+                            return False
+                    return True
+                return await self.drop_rows(rows, e)
+            except Forbidden as e:
+                return await self.drop_rows(rows, e)
+            except Exception as e:
+                attempts += 1
+                if attempts >= NOTIFY_MAX_ATTEMPTS:
+                    logger.error(f"Giving up on {len(rows)} notification(s) for chat {chat_id} after {attempts} attempts: {e}")
+                    await run_db(remove_from_outbox, row_ids)
+                    self.failed += len(rows)
+                    ALERTS_FAILED.inc(len(rows))
+                    return True
+                delay = min(NOTIFY_RETRY_BASE_DELAY * 2 ** (attempts - 1), NOTIFY_RETRY_MAX_DELAY)
+                logger.warning(f"Error sending notification to chat {chat_id} (attempt {attempts}), retrying in {delay} seconds: {e}")
+                # Holding back the oldest row holds back the rest of the chat's queue too
+                await run_db(reschedule_outbox, row_ids[0], attempts, time.time() + delay)
+                return False
+    
+    async def drop_rows(self, rows, error):
+        """Drop rows that retrying won't help (bad HTML, blocked bot, ...)"""
+        logger.error(f"Dropping {len(rows)} notification(s) for chat {rows[0][1]}: {error}")
+        await run_db(remove_from_outbox, [row[0] for row in rows])
+        self.failed += len(rows)
+        ALERTS_FAILED.inc(len(rows))
+        return True
     
-    message += f"\n<a href='{url}'>🔗 View on SHEIN</a>"
+    async def deliver(self, chat_id, payload):
+        """Make the Telegram API call for one payload"""
+        parse_mode = payload.get('parse_mode', 'HTML')
+        if payload.get('photo'):
+            try:
+                await self.bot.send_photo(chat_id=chat_id, photo=payload['photo'], caption=payload['text'], parse_mode=parse_mode)
+                return
+            except BadRequest as e:
+                # Usually an image URL Telegram can't fetch, fall back to a text message
+                logger.warning(f"Sending photo to chat {chat_id} failed, sending text instead: {e}")
+        await self.bot.send_message(chat_id=chat_id, text=payload['text'], parse_mode=parse_mode)
+    
+    async def deliver_album(self, chat_id, payloads):
+        """Send photo payloads as one media group album"""
+        if len(payloads) == 1:
+            await self.deliver(chat_id, payloads[0])
+            return
+        media = [InputMediaPhoto(media=payload['photo'], caption=payload['text'], parse_mode='HTML') for payload in payloads]
+        await self.bot.send_media_group(chat_id=chat_id, media=media)
+
+# Digest sections in display order: payload 'digest' value -> heading
+DIGEST_SECTIONS = {
+    'out_of_stock': '❌ <b>OUT OF STOCK</b>',
+    'price_change': '💰 <b>PRICE CHANGES</b>',
+    'sizes': '👕 <b>SIZES BACK IN STOCK</b>',
+}
+DIGEST_HEADER = '📋 <b>CATALOG UPDATES</b>'
+
+def render_digest(payloads):
+    """Combine digest payloads into one message, grouped by section"""
+    sections = {}
+    for payload in payloads:
+        sections.setdefault(payload['digest'], []).append(payload['text'])
+    
+    parts = [DIGEST_HEADER]
+    for section, heading in DIGEST_SECTIONS.items():
+        lines = sections.pop(section, None)
+        if lines:
+            parts.append(f"\n{heading} ({len(lines)})")
+            parts.extend(lines)
+    for section, lines in sections.items():
+        parts.append(f"\n<b>{section}</b> ({len(lines)})")
+        parts.extend(lines)
+    return '\n'.join(parts)
+
+def outbox_row_kind(payload):
+    """Classify a payload for batching: 'album', 'digest' or 'single'"""
+    if payload.get('album') and payload.get('photo'):
+        return 'album'
+    if payload.get('digest'):
+        return 'digest'
+    return 'single'
+
+def group_outbox_rows(rows):
+    """Split one chat's rows into (kind, rows) batches, each sent with one API call.
     
-    return message, image_url
+    Consecutive album rows form albums of up to MEDIA_GROUP_LIMIT photos, and
+    consecutive digest rows are packed into messages under TELEGRAM_MESSAGE_LIMIT.
+    """
+    batches = []
+    digest_length = 0
+    # Room for the digest header and section headings
+    digest_overhead = len(DIGEST_HEADER) + sum(len(heading) + 10 for heading in DIGEST_SECTIONS.values()) + 64
+    
+    for row in rows:
+        payload = row[2]
+        kind = outbox_row_kind(payload)
+        line_length = len(payload.get('text', '')) + 1
+        
+        if batches and batches[-1][0] == kind:
+            last_rows = batches[-1][1]
+            if kind == 'album' and len(last_rows) < MEDIA_GROUP_LIMIT:
+                last_rows.append(row)
+                continue
+            if kind == 'digest' and digest_length + line_length + digest_overhead <= TELEGRAM_MESSAGE_LIMIT:
+                last_rows.append(row)
+                digest_length += line_length
+                continue
+        
+        batches.append((kind, [row]))
+        digest_length = line_length
+    return batches
+
+NOTIFICATION_DISPATCHER = None
+
+async def enqueue_alerts(alerts):
+    """Queue (chat_id, payload) monitor alerts into the chat's coalescing window"""
+    await run_db(add_to_outbox, alerts, delay=ALERT_COALESCE_WINDOW)
+    if NOTIFICATION_DISPATCHER is not None:
+        NOTIFICATION_DISPATCHER.notify()
+
+async def enqueue_notification(chat_id, text, photo=None, parse_mode='HTML'):
+    """Queue a single command output message for the dispatcher and return immediately"""
+    await run_db(add_to_outbox, [(chat_id, {'text': text, 'photo': photo, 'parse_mode': parse_mode})], priority=NOTIFY_PRIORITY_BULK)
+    if NOTIFICATION_DISPATCHER is not None:
+        NOTIFICATION_DISPATCHER.notify()
 
 # --- MONITORING FUNCTION (CHAT_ID UPDATED FOR ALERTS) ---
 
+PRODUCT_ALERT_TASKS = set()  # delivery checks for new/restocked product alerts, running off the monitor pass
+
+async def send_product_alerts(new_products, restocked_products, product_watches):
+    """Check delivery for new and restocked products, then queue their album alerts and record them as notified"""
+    try:
+        album_products = [('🆕 <b>NEW PRODUCT ALERT!</b>', product) for product in new_products]
+        album_products += [('🔄 <b>BACK IN STOCK!</b>', product) for product in restocked_products]
+        # Check delivery once per product and pin, however many watches share them
+        pin_codes = list(dict.fromkeys(pin for _, product in album_products for watch in product_watches[product.code] for pin in watch.pin_codes))
+        matrix = await check_delivery_matrix([product.code for _, product in album_products], pin_codes)
+        alerts = []
+        for heading, product in album_products:
+            row = matrix.row(product.code)
+            for chat_id, chat_pin_codes in alert_targets(product_watches[product.code]).items():
+                message, image_url = format_product_info(product, delivery_info={pin: row[pin] for pin in chat_pin_codes})
+                alerts.append((chat_id, {'text': f"{heading}\n\n{message}", 'photo': image_url, 'album': True}))
+        await enqueue_alerts(alerts)
+        await NOTIFICATION_LEDGER.record(NOTIFIED_NEW_PRODUCT, [product.code for product in new_products])
+        await NOTIFICATION_LEDGER.record(NOTIFIED_RESTOCK, [product.code for product in restocked_products])
+    except Exception as e:
+        logger.error(f"Error sending new/restocked product alerts: {e}")
+
+async def prune_delisted_products(existing_codes):
+    """Forget products delisted for over STOCK_OUT_RETENTION_DAYS, in memory and on disk; returns how many"""
+    cutoff = time.time() - STOCK_OUT_RETENTION_DAYS * 86400
+    # Products flagged out of stock while still listed are kept
+    codes = [code for code in await run_db(load_delisted_codes, cutoff) if code in CATALOG_DIFF.removed]
+    if not codes:
+        return 0
+    await run_db(delete_products, codes)
+    CATALOG_DIFF.forget(codes)
+    STOCK_TRACKER.forget(codes)
+    existing_codes.difference_update(codes)
+    for code in codes:
+        PREVIOUS_CATALOG.pop(code, None)
+    return len(codes)
+
 async def monitor_catalog_changes(application):
-    """Monitor catalog changes in real-time"""
-    global PREVIOUS_CATALOG, PRODUCTS_CACHE
+    """Monitor catalog changes in real-time across all watches"""
+    global PREVIOUS_CATALOG
+    
+    # Load existing product codes and stock states
+    existing_codes = await run_db(load_product_codes)
+    stock_states = await run_db(load_stock_states)
+    STOCK_TRACKER.seed(stock_states, WATCH_SCHEDULER.sweeps)
+    # Missing products come back as BACK_IN_STOCK events too, so the tracker can tell jitter from a restock
+    gone_codes = set(code for code, state, _ in stock_states if state in (STOCK_MISSING, STOCK_OUT))
+    
+    # Load previous catalog and seed the diff engine with it
+    if not PREVIOUS_CATALOG:
+        PREVIOUS_CATALOG = await run_db(load_product_details)
+    await run_blocking(CATALOG_DIFF.seed, PREVIOUS_CATALOG, existing_codes, gone_codes)
+    for code, state, _ in stock_states:
+        if state == STOCK_OUT:
+            PREVIOUS_CATALOG.pop(code, None)
     
-    # Load notification tracking files
-    notified_out_of_stock = load_notified_out_of_stock()
-    notified_new_products = load_notified_new_products()
-    notified_price_changes = load_notified_price_changes()
+    # Products known from before price history existed start with their current price
+    await run_db(backfill_price_history, list(PREVIOUS_CATALOG.values()))
+    
+    # Which watches listed each product in the last processed pass (to route alerts for removed products)
+    last_product_watches = {}
+    last_generations = None
+    # The first sweep of a new watch (or of every watch after an upgrade) only records what is listed, without alerts
+    baselined_scopes = await run_db(load_baselined_scopes)
+    next_prune_at = 0
     
     while True:
+        # The scheduler sweeps the watches and wakes us when any of them changed
+        await WATCH_SCHEDULER.changed.wait()
+        WATCH_SCHEDULER.changed.clear()
         try:
-            # Fetch current catalog
-            catalog_data = fetch_catalog()
-            if not catalog_data:
-                await asyncio.sleep(30)  # Wait 30 seconds before retrying on error
+            snapshots = [CATALOG_SNAPSHOTS[watch.name].current for watch in WATCH_LIST]
+            if not all(snapshots):
+                # Until every watch was swept once, products on the missing ones would look removed
                 continue
             
-            current_products = catalog_data.get('products', [])
-            current_codes = set(product.get('code') for product in current_products if product.get('code'))
-            
-            # Load previous catalog if available
-            if not PREVIOUS_CATALOG:
-                PREVIOUS_CATALOG = load_product_details()
-            
-            # Load existing product codes
-            existing_codes = load_product_codes()
-            out_of_stock = load_out_of_stock()
+            MONITOR_STATS['passes'] += 1
+            pass_started = time.perf_counter()
+            generations = tuple(snapshot.generation for snapshot in snapshots)
+            catalog_changed = generations != last_generations
+            if catalog_changed:
+                current_products, product_watches = await run_blocking(merge_watch_snapshots, snapshots)
+                events, changed_products = await run_blocking(CATALOG_DIFF.diff, current_products)
+                last_generations = generations
+            else:
+                # Nothing new upstream, this pass only moves missing products towards confirmation
+                product_watches, events, changed_products = last_product_watches, [], {}
             
-            # Check for new products
             new_products = []
-            for product in current_products:
-                code = product.get('code')
-                if code and code not in existing_codes:
-                    new_products.append(product)
-                    existing_codes.add(code)
+            new_codes = set()
+            baseline_scopes = set(watch.scope for watch in WATCH_LIST) - baselined_scopes
             
-            # Check for removed products (out of stock) - only if not already notified
-            removed_products = []
-            for code in existing_codes:
-                if code not in current_codes and code not in notified_out_of_stock:
-                    # Retrieve details before potentially deleting (if product removed from PREVIOUS_CATALOG)
-                    if code in PREVIOUS_CATALOG:
-                        removed_products.append(PREVIOUS_CATALOG[code])
-                    else:
-                        removed_products.append({'code': code, 'name': 'Unknown Product'})
-                    out_of_stock.add(code)
-                    notified_out_of_stock.add(code)
+            for event in events:
+                if event.kind == EVENT_ADDED and event.code not in existing_codes:
+                    # Check for new products (only listed by watches still being baselined: record silently)
+                    if any(watch.scope not in baseline_scopes for watch in product_watches[event.code]):
+                        new_products.append(event.product)
+                    existing_codes.add(event.code)
+                    new_codes.add(event.code)
             
-            # Check for price changes - only if not already notified
-            price_changes = []
-            for product in current_products:
-                code = product.get('code')
-                if code and code in PREVIOUS_CATALOG:
-                    prev_price = PREVIOUS_CATALOG.get(code, {}).get('price', {}).get('formattedValue', '')
-                    curr_price = product.get('price', {}).get('formattedValue', '')
-                    
-                    # Create a unique key for price change
-                    price_change_key = f"{code}_{prev_price}_{curr_price}"
-                    
-                    if (prev_price and curr_price and prev_price != curr_price and 
-                        price_change_key not in notified_price_changes):
-                        price_changes.append((product, old_price, curr_price))
-                        notified_price_changes[price_change_key] = datetime.now().isoformat()
+            # Advance the stock state machine (products only count as out of stock after a few sweeps)
+            stock_changes, sold_out_codes, restocked_codes = STOCK_TRACKER.update(events, last_product_watches, WATCH_SCHEDULER.sweeps)
+            sold_out_products = [(PREVIOUS_CATALOG.get(code) or Product(code=code),
+                                  product_watches.get(code) or last_product_watches.get(code) or WATCH_LIST)
+                                 for code in sold_out_codes]
             
-            # Update previous catalog
-            for product in current_products:
-                code = product.get('code')
-                if code:
-                    PREVIOUS_CATALOG[code] = product
+            # Update previous catalog with the products that actually changed
+            PREVIOUS_CATALOG.update(changed_products)
+            for code in sold_out_codes:
+                if code not in product_watches:
+                    # Gone from the catalog: keep it in the database only, not in memory
+                    PREVIOUS_CATALOG.pop(code, None)
             
-            # Save updated data
-            save_product_codes(existing_codes)
-            save_product_details(PREVIOUS_CATALOG)
-            save_out_of_stock(out_of_stock)
-            save_notified_out_of_stock(notified_out_of_stock)
-            save_notified_price_changes(notified_price_changes)
+            # Queue variant lookups for tracked products, new and restocked ones first
+            if catalog_changed:
+                VARIANT_TRACKER.observe(product_watches, list(new_codes) + restocked_codes, changed_products.keys())
             
-            # Update products cache (for immediate use if user asks)
-            PRODUCTS_CACHE = {str(i+1): product for i, product in enumerate(current_products)}
+            # Save updated data (only rows that changed are written); price points come back as trend signals
+            price_signals = await run_db(save_monitor_changes, new_codes, changed_products, stock_changes)
+            if baseline_scopes:
+                await run_db(save_baselined_scopes, baseline_scopes)
+                baselined_scopes |= baseline_scopes
+                logger.info(f"Baselined {len(baseline_scopes)} watch listings, {len(new_codes) - len(new_products)} products recorded without alerts")
+            # Products still missing keep the watches they were last listed on
+            last_product_watches = {**{code: last_product_watches[code] for code in STOCK_TRACKER.missing if code in last_product_watches},
+                                    **product_watches} if STOCK_TRACKER.missing else product_watches
             
-            # Send notifications for new products (using the updated CHAT_ID)
-            for product in new_products:
-                code = product.get('code')
-                if code and code not in notified_new_products:
-                    # Check delivery for all monitor pins
-                    delivery_info = await check_delivery_for_all_pins(code) 
-                    message, image_url = format_product_info(product, delivery_info=delivery_info)
-                    
-                    try:
-                        if image_url:
-                            await application.bot.send_photo(
-                                chat_id=CHAT_ID, # UPDATED
-                                photo=image_url,
-                                caption=f"🆕 <b>NEW PRODUCT ALERT!</b>\n\n{message}",
-                                parse_mode='HTML'
-                            )
-                        else:
-                            await application.bot.send_message(
-                                chat_id=CHAT_ID, # UPDATED
-                                text=f"🆕 <b>NEW PRODUCT ALERT!</b>\n\n{message}",
-                                parse_mode='HTML'
-                            )
-                        
-                        # Mark as notified
-                        notified_new_products.add(code)
-                        save_notified_new_products(notified_new_products)
-                        
-                        await asyncio.sleep(0.5) # Small delay
-                    except Exception as e:
-                        logger.error(f"Error sending new product notification: {e}")
+            # New and restocked products go to the chats of every watch listing them, sent as albums once
+            # their delivery is checked; that can take minutes in a drop, so it runs beside the next passes
+            notified_new_products = await NOTIFICATION_LEDGER.seen(NOTIFIED_NEW_PRODUCT, [product.code for product in new_products])
+            new_products = [product for product in new_products if product.code not in notified_new_products]
+            notified_restocks = await NOTIFICATION_LEDGER.seen(NOTIFIED_RESTOCK, restocked_codes)
+            restocked_products = [changed_products.get(code) or PREVIOUS_CATALOG[code] for code in restocked_codes if code not in notified_restocks]
+            if new_products or restocked_products:
+                task = asyncio.ensure_future(send_product_alerts(
+                    new_products, restocked_products,
+                    {product.code: product_watches[product.code] for product in new_products + restocked_products}
+                ))
+                PRODUCT_ALERT_TASKS.add(task)
+                task.add_done_callback(PRODUCT_ALERT_TASKS.discard)
             
-            # Send notifications for removed products (using the updated CHAT_ID)
-            for product in removed_products:
-                code = product.get('code')
-                product_name = product.get('name', 'Unknown Product')
-                message = f"❌ <b>PRODUCT OUT OF STOCK!</b>\n\n"
-                message += f"<b>{product_name}</b>\n"
-                message += f"Code: {code}\n\n"
-                message += f"This product is no longer available in the catalog."
-                
-                try:
-                    await application.bot.send_message(
-                        chat_id=CHAT_ID, # UPDATED
-                        text=message,
-                        parse_mode='HTML'
-                    )
-                    await asyncio.sleep(0.5) # Small delay
-                except Exception as e:
-                    logger.error(f"Error sending out of stock notification: {e}")
+            alerts = []
+            # Queue products confirmed out of stock for the digest of the chats that were watching them
+            notified_out_of_stock = await NOTIFICATION_LEDGER.seen(NOTIFIED_OUT_OF_STOCK, sold_out_codes)
+            sold_out_products = [(product, watches) for product, watches in sold_out_products if product.code not in notified_out_of_stock]
+            for product, watches in sold_out_products:
+                code = product.code
+                product_name = html.escape(product.name)
+                for chat_id in alert_targets(watches):
+                    alerts.append((chat_id, {'digest': 'out_of_stock', 'text': f"• <b>{product_name}</b> ({html.escape(code)})"}))
             
-            # Send notifications for price changes (using the updated CHAT_ID)
-            for product, old_price, new_price in price_changes:
-                code = product.get('code')
-                product_name = product.get('name', 'Unknown Product')
-                message = f"💰 <b>PRICE CHANGE ALERT!</b>\n\n"
-                message += f"<b>{product_name}</b>\n"
-                message += f"Code: {code}\n\n"
-                message += f"Old Price: {old_price}\n"
-                message += f"New Price: {new_price}\n\n"
-                message += f"<a href='https://www.sheinindia.in/p/{code}'>🔗 View on SHEIN</a>"
-                
-                try:
-                    await application.bot.send_message(
-                        chat_id=CHAT_ID, # UPDATED
-                        text=message,
-                        parse_mode='HTML'
-                    )
-                    await asyncio.sleep(0.5) # Small delay
-                except Exception as e:
-                    logger.error(f"Error sending price change notification: {e}")
+            # Queue price changes for the digest of the chats watching them (a price flipping back and forth alerts once per TTL)
+            price_change_keys = {f"{signal.code}_{format_price_value(signal.old)}_{format_price_value(signal.new)}": signal
+                                 for signal in price_signals}
+            notified_price_changes = await NOTIFICATION_LEDGER.seen(NOTIFIED_PRICE_CHANGE, price_change_keys)
+            price_change_keys = {key: signal for key, signal in price_change_keys.items() if key not in notified_price_changes}
+            for signal in price_change_keys.values():
+                code = html.escape(signal.code)
+                product_name = html.escape(changed_products[signal.code].name)
+                text = (f"• <a href='https://www.sheinindia.in/p/{code}'>{product_name}</a> ({code}): "
+                        f"{format_price_value(signal.old)} → {format_price_value(signal.new)} ({signal.change_pct:+.0f}%)")
+                if signal.all_time_low:
+                    text += " 🏆 all-time low"
+                elif signal.change_pct <= -PRICE_ALERT_BIG_DROP_PCT:
+                    text += " 🔥 big drop"
+                for chat_id in alert_targets(product_watches[signal.code]):
+                    alerts.append((chat_id, {'digest': 'price_change', 'text': text}))
             
-            # Wait 5 seconds before next check (reduced frequency to avoid rate limiting)
-            await asyncio.sleep(5)
+            # The outbox is durable, so alerts count as notified once they are queued
+            await enqueue_alerts(alerts)
+            await NOTIFICATION_LEDGER.record(NOTIFIED_OUT_OF_STOCK, [product.code for product, _ in sold_out_products])
+            await NOTIFICATION_LEDGER.record(NOTIFIED_PRICE_CHANGE, price_change_keys)
+            
+            # Products that stay delisted are eventually forgotten, so the known codes don't only grow
+            if time.monotonic() >= next_prune_at:
+                next_prune_at = time.monotonic() + LEDGER_COMPACT_INTERVAL
+                pruned = await prune_delisted_products(existing_codes)
+                if pruned:
+                    logger.info(f"Forgot {pruned} products delisted for over {STOCK_OUT_RETENTION_DAYS} days")
+            MONITOR_PASS_SECONDS.set(round(time.perf_counter() - pass_started, 4))
             
         except Exception as e:
             logger.error(f"Error in catalog monitoring: {e}")
@@ -548,12 +3201,13 @@ async def deliverable_products_command(update: Update, context: ContextTypes.DEF
         parse_mode='Markdown'
     )
     
-    catalog_data = fetch_catalog()
-    if not catalog_data:
-        await progress_message.edit_text("❌ Failed to fetch products. Please try again later.\n\nIf this error persists, the cookies may have expired. Please update them in the script.")
+    # Reuse the monitor's latest sweep when it is recent enough
+    snapshot = await CATALOG_SNAPSHOTS[DEFAULT_WATCH.name].get()
+    if not snapshot:
+        await progress_message.edit_text(catalog_unavailable_message())
         return
     
-    products = catalog_data.get('products', [])
+    products = snapshot.products
     if not products:
         await progress_message.edit_text("❌ No products found.")
         return
@@ -561,83 +3215,67 @@ async def deliverable_products_command(update: Update, context: ContextTypes.DEF
     # Update progress
     await progress_message.edit_text(
         f"🔍 Checking delivery for {len(products)} products to **{pin_display}**...\n\n"
-        f"⚡ Processing with {executor._max_workers} concurrent workers!",
+        f"⚡ Processing with {DELIVERY_MAX_CONCURRENCY} concurrent checks!",
         parse_mode='Markdown'
     )
     
     deliverable_products = []
     checked_count = 0
     start_time = time.time()
+    last_edit_at = start_time
+    chat_id = update.effective_chat.id
     
-    async def check_single_product_delivery_for_pin(product, index, total, pin_codes_to_check):
-        """Check delivery for a single product against the list of pin codes"""
-        code = product.get('code')
-        if not code:
-            return None
-        
+    # Numbered as they are found, so /checkdelivery works while the scan is still running
+    RESULT_SESSIONS.start(chat_id, effective_user_id(update), deliverable_products, target_pin_codes)
+    
+    products_by_code = {product.code: product for product in products}
+    total_products = len(products_by_code)
+    matrix = DeliveryMatrix(products_by_code, target_pin_codes)
+    
+    # Fan the whole product × pin matrix out through the shared delivery scheduler,
+    # queueing each deliverable product for sending as soon as its row is complete
+    async for code, pin_code, info in iter_delivery_matrix(matrix.product_codes, matrix.pin_codes):
         try:
-            delivery_info = await check_delivery_for_pins(code, pin_codes_to_check)
+            if not matrix.add(code, pin_code, info):
+                continue
+            checked_count += 1
             
-            # Check if product is deliverable to ANY of the pin codes in the list (in this case, just one pin)
-            is_deliverable = any(info['serviceable'] for info in delivery_info.values())
+            # Check if product is deliverable to ANY of the pin codes in the list
+            if matrix.is_deliverable(code):
+                product = products_by_code[code]
+                index = len(deliverable_products)
+                deliverable_products.append(product)
+                message, image_url = format_product_info(product, index=index, delivery_info=matrix.row(code))
+                await enqueue_notification(chat_id, message, image_url)
             
-            if is_deliverable:
-                return (product, delivery_info)
-        except Exception as e:
-            logger.error(f"Error checking delivery for product {code}: {e}")
-        
-        return None
-
-    # Process products in batches to avoid overwhelming the API
-    batch_size = 5
-    for batch_start in range(0, len(products), batch_size):
-        batch_end = min(batch_start + batch_size, len(products))
-        batch = products[batch_start:batch_end]
-        
-        # Create tasks for this batch
-        tasks = []
-        for i, product in enumerate(batch):
-            task = asyncio.create_task(
-                check_single_product_delivery_for_pin(product, batch_start + i, len(products), target_pin_codes)
-            )
-            tasks.append(task)
-        
-        # Wait for all tasks in this batch to complete
-        for task in asyncio.as_completed(tasks):
-            try:
-                result = await task
-                if result:
-                    deliverable_products.append(result)
-                checked_count += 1
+            # Update progress at a fixed interval
+            now = time.time()
+            if now - last_edit_at >= PROGRESS_EDIT_INTERVAL and checked_count < total_products:
+                last_edit_at = now
+                elapsed = now - start_time
+                rate = checked_count / elapsed if elapsed > 0 else 0
+                eta = (total_products - checked_count) / rate if rate > 0 else 0
                 
-                # Update progress every 5 products or every 2 seconds
-                if checked_count % 5 == 0 or time.time() - start_time > 2:
-                    elapsed = time.time() - start_time
-                    rate = checked_count / elapsed if elapsed > 0 else 0
-                    eta = (len(products) - checked_count) / rate if rate > 0 else 0
-                    
-                    await progress_message.edit_text(
-                        f"🔍 Checking delivery for {len(products)} products to **{pin_display}**...\n\n"
-                        f"✅ Checked: {checked_count}/{len(products)}\n"
-                        f"📦 Deliverable: {len(deliverable_products)}\n"
-                        f"⚡ Speed: {rate:.1f} products/sec\n"
-                        f"⏱️ ETA: {eta:.1f} seconds",
-                        parse_mode='Markdown'
-                    )
-            except Exception as e:
-                logger.error(f"Error in task: {e}")
-        
-        # Small delay between batches to avoid rate limiting
-        await asyncio.sleep(0.5)
+                await progress_message.edit_text(
+                    f"🔍 Checking delivery for {total_products} products to **{pin_display}**...\n\n"
+                    f"✅ Checked: {checked_count}/{total_products}\n"
+                    f"📦 Deliverable: {len(deliverable_products)} (sending as found)\n"
+                    f"⚡ Speed: {rate:.1f} products/sec\n"
+                    f"⏱️ ETA: {eta:.1f} seconds",
+                    parse_mode='Markdown'
+                )
+        except Exception as e:
+            logger.error(f"Error in task: {e}")
     
     # Final progress update
     elapsed = time.time() - start_time
+    N_COMMAND_RATE.set(round(total_products / elapsed if elapsed > 0 else 0, 2))
     await progress_message.edit_text(
         f"✅ Delivery check completed for **{pin_display}**!\n\n"
-        f"📊 Total Products: {len(products)}\n"
+        f"📊 Total Products: {total_products}\n"
         f"📦 Deliverable: {len(deliverable_products)}\n"
         f"⏱️ Time Taken: {elapsed:.1f} seconds\n"
-        f"⚡ Average Speed: {len(products)/elapsed:.1f} products/sec",
+        f"⚡ Average Speed: {total_products / elapsed if elapsed > 0 else 0:.1f} products/sec",
         parse_mode='Markdown'
     )
     
@@ -645,36 +3283,8 @@ async def deliverable_products_command(update: Update, context: ContextTypes.DEF
         await update.message.reply_text(f"❌ No products are deliverable to pin code **{pin_display}**.", parse_mode='Markdown')
         return
     
-    # Store deliverable products in cache with indices
-    global PRODUCTS_CACHE
-    PRODUCTS_CACHE = {str(i+1): product for i, (product, _) in enumerate(deliverable_products)}
-    
-    # Send deliverable products
-    await update.message.reply_text(f"📤 Sending {len(deliverable_products)} deliverable products for **{pin_display}**...", parse_mode='Markdown')
-    
-    for i, (product, delivery_info) in enumerate(deliverable_products):
-        message, image_url = format_product_info(product, index=i, delivery_info=delivery_info)
-        
-        try:
-            if image_url:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=image_url,
-                    caption=message,
-                    parse_mode='HTML'
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=message,
-                    parse_mode='HTML'
-                )
-            
-            await asyncio.sleep(0.3)
-        except Exception as e:
-            logger.error(f"Error sending product {product.get('code')}: {e}")
-    
-    await update.message.reply_text(f"✅ All {len(deliverable_products)} deliverable products for **{pin_display}** sent! Use /checkdelivery <number> to check delivery again.", parse_mode='Markdown')
+    # Queued behind the products so it arrives after the last one
+    await enqueue_notification(chat_id, f"✅ All {len(deliverable_products)} deliverable products for **{pin_display}** sent! Use /checkdelivery <number> to check delivery again.", parse_mode='Markdown')
 
 # --- REVISED CHECK DELIVERY COMMAND HANDLER ---
 
@@ -686,46 +3296,33 @@ async def check_delivery_command(update: Update, context: ContextTypes.DEFAULT_T
     
     product_number = context.args[0]
     
-    # Check if products cache is populated
-    if not PRODUCTS_CACHE:
+    # Resolve the number against the list this user (or else this chat) was last shown
+    session = RESULT_SESSIONS.get(update.effective_chat.id, effective_user_id(update))
+    if not session:
         await update.message.reply_text("❌ No products cached. Please run /products or /n first.")
         return
     
-    # Get product from cache
-    product = PRODUCTS_CACHE.get(product_number)
+    product = session.product(product_number)
     if not product:
         await update.message.reply_text(f"❌ Product #{product_number} not found. Please use /products or /n to see available products.")
         return
     
-    code = product.get('code')
+    code = product.code
     progress_message = await update.message.reply_text(f"🔍 Checking delivery for product **#{product_number}** (*{code}*)...", parse_mode='Markdown')
     
-    # Determine which pin codes to check:
-    # 1. If the last /n command used a specific pin, we should keep that pin for reference. 
-    # 2. Otherwise, check against the default MONITOR_PIN_CODES.
-    
-    # A simple way to handle this without full state management is to just check the monitor pins, 
-    # but for a true representation of the /n list, we need the PIN_CODES used for the cached products.
-    # Since the original script just checked MONITOR_PIN_CODES here anyway, we'll maintain that for simplicity:
-    
-    # The /n command now uses the `target_pin_codes` list, but that variable is local to `deliverable_products_command`.
-    # A cleaner approach would be to check a set of relevant pins for /checkdelivery, let's use the MONITOR_PIN_CODES.
-    delivery_info = await check_delivery_for_all_pins(code)
+    # Re-check the pins the list was built for (answered from the delivery cache when still fresh)
+    delivery_info = await check_delivery_for_pins(code, session.pin_codes)
 
-    message = f"📦 <b>Product #{product_number} - {product.get('name', 'Unknown')}</b>\n"
-    message += f"Code: {code}\n\n"
-    message += f"<b>🚚 Delivery Status:</b>\n"
+    price_summary = await run_db(get_price_summary, code)
+    variants = None
+    if VARIANT_TRACKER.tracks(WATCH_LIST):
+        variants = await get_product_variants(code)
     
-    # The delivery info object keys are the pins checked (MONITOR_PIN_CODES for /checkdelivery)
-    for pin_code, info in delivery_info.items():
-        message += f"\n📍 <b>{pin_code}:</b>\n"
-        message += f"Serviceable: {'✅ Yes' if info['serviceable'] else '❌ No'}\n"
-        if info['serviceable']:
-            message += f"Delivery Method: {info['delivery_method']}\n"
-            message += f"COD Available: {'✅ Yes' if info['cod_eligible'] else '❌ No'}\n"
-        else:
-            if info['reason']:
-                message += f"Reason: {info['reason']}\n"
+    message = (f"📦 <b>Product #{html.escape(product_number)} - {html.escape(product.name)}</b>\n"
+               f"Code: {html.escape(code)}\n"
+               + render_price_summary(price_summary)
+               + render_variant_summary(variants)
+               + render_delivery_section(delivery_info))
     
     await progress_message.edit_text(message, parse_mode='HTML')
 
@@ -741,10 +3338,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/n <pincode> - View deliverable products for that specific pincode\n" # ADDED INFO
         "/checkdelivery <number> - Check delivery for product by number\n"
         "/status - Check monitoring status\n"
-        "/reset - Reset notification tracking\n"
+        "/reset [new|oos|restock|price] [code] - Reset notification tracking (all, one category and/or one product)\n"
         "/help - Show this help message\n\n"
         "💡 Products are numbered for easy reference!\n"
-        "🔔 Real-time monitoring is active to the group! You'll be notified of new products, out of stock items, and price changes!\n"
+        "🔔 Real-time monitoring is active to the group! You'll be notified of new products, restocks, out of stock items, and price changes!\n"
         "⚡ Optimized for speed with concurrent processing!"
     )
 
@@ -757,48 +3354,126 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/n <pincode> - View deliverable products for that specific pincode\n" # ADDED INFO
         "/checkdelivery <number> - Check delivery for product by number\n"
         "/status - Check monitoring status\n"
-        "/reset - Reset notification tracking\n"
+        "/reset [new|oos|restock|price] [code] - Reset notification tracking (all, one category and/or one product)\n"
         "/help - Show this help message\n\n"
         "💡 Use /products or /n first to see numbered products, then use /checkdelivery <number>\n"
-        "🔔 Real-time monitoring is active to the group! You'll be notified of new products, out of stock items, and price changes!\n"
+        "🔔 Real-time monitoring is active to the group! You'll be notified of new products, restocks, out of stock items, and price changes!\n"
         "⚡ Optimized for speed with concurrent processing!"
     )
 
+def catalog_snapshot_status():
+    """One-line summary of the shared catalog snapshots for /status"""
+    stores = CATALOG_SNAPSHOTS.values()
+    snapshot = CATALOG_SNAPSHOTS[DEFAULT_WATCH.name].current
+    if snapshot is None:
+        return "not fetched yet"
+    return (f"{DEFAULT_WATCH.name} generation {snapshot.generation}, {len(snapshot.products)} products, {snapshot.age:.0f}s old "
+            f"({sum(store.reused for store in stores)} reused, {sum(store.coalesced for store in stores)} coalesced, "
+            f"{sum(store.refreshes for store in stores)} sweeps)")
+
+def polling_status():
+    """One-line summary of the adaptive polling intervals for /status"""
+    pacer = WATCH_SCHEDULER.pacers[DEFAULT_WATCH.name]
+    intervals = [pacer.interval for pacer in WATCH_SCHEDULER.pacers.values()]
+    summary = f"{DEFAULT_WATCH.name} every {pacer.interval:.1f}s, {pacer.change_rate:.0%} of sweeps changing"
+    if len(intervals) > 1:
+        summary += f" (all watches {min(intervals):.1f}-{max(intervals):.1f}s)"
+    return summary
+
+def watches_status():
+    """One-line summary of the configured watches for /status"""
+    names = ', '.join(watch.name for watch in WATCH_LIST[:5])
+    more = f" +{len(WATCH_LIST) - 5} more" if len(WATCH_LIST) > 5 else ""
+    chats = len({watch.chat_id for watch in WATCH_LIST})
+    return f"{len(WATCH_LIST)} ({names}{more}) alerting {chats} chat(s)"
+
+def variant_status():
+    """Variant tracking summary for /status"""
+    if not VARIANT_TRACKER.tracks(WATCH_LIST):
+        return "off"
+    stats = VARIANT_TRACKER.stats
+    return (f"{len(VARIANT_TRACKER.sizes)} products resolved, {len(VARIANT_TRACKER.queued)} queued, "
+            f"{stats['lookups']} lookups ({stats['failed']} failed), {stats['alerts']} size alerts")
+
+def ledger_status():
+    """Filter effectiveness and compaction summary for /status"""
+    stats = NOTIFICATION_LEDGER.stats
+    filtered = f"{stats['filtered'] / stats['lookups']:.0%}" if stats['lookups'] else "n/a"
+    return (f"{stats['lookups']} lookups, {filtered} answered by the filter, "
+            f"{stats['compactions']} compactions ({stats['compacted']} entries dropped)")
+
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check monitoring status."""
-    existing_codes = load_product_codes()
-    out_of_stock = load_out_of_stock()
-    notified_out_of_stock = load_notified_out_of_stock()
-    notified_new_products = load_notified_new_products()
-    notified_price_changes = load_notified_price_changes()
+    cache_stats = DELIVERY_CACHE.stats()
+    counts = await run_db(get_state_counts)
+    pending_notifications = await run_db(count_outbox)
+    price_series, price_points = await run_db(count_price_history)
+    NOTIFICATION_QUEUE_DEPTH.set(pending_notifications)
     
     await update.message.reply_text(
         f"📊 <b>Monitoring Status</b>\n\n"
-        f"✅ Active Products: {len(existing_codes)}\n"
-        f"❌ Out of Stock: {len(out_of_stock)}\n"
-        f"📢 Notified Out of Stock: {len(notified_out_of_stock)}\n"
-        f"📢 Notified New Products: {len(notified_new_products)}\n"
-        f"📢 Notified Price Changes: {len(notified_price_changes)}\n"
+        f"✅ Active Products: {counts['product_codes']}\n"
+        f"❌ Out of Stock: {counts['stock'][STOCK_OUT]} ({counts['stock'][STOCK_MISSING]} missing, awaiting confirmation)\n"
+        f"🔄 Restocked: {counts['stock'][STOCK_RESTOCKED]}\n"
+        f"📢 Notified Out of Stock: {counts['notified'][NOTIFIED_OUT_OF_STOCK]}\n"
+        f"📢 Notified New Products: {counts['notified'][NOTIFIED_NEW_PRODUCT]}\n"
+        f"📢 Notified Restocks: {counts['notified'][NOTIFIED_RESTOCK]}\n"
+        f"🧮 Dedup Ledger: {ledger_status()}\n"
+        f"📈 Price History: {price_series} products, {price_points} points\n"
         f"🔄 Real-time Monitoring: Active\n"
-        f"📍 Monitoring Pin Codes: {', '.join(MONITOR_PIN_CODES)}\n" # Changed to MONITOR_PIN_CODES
+        f"📬 Pending Notifications: {pending_notifications}\n"
+        f"👀 Watches: {watches_status()}\n"
+        f"⏱️ Polling: {polling_status()}\n"
+        f"📍 Monitoring Pin Codes: {', '.join(dict.fromkeys(pin for watch in WATCH_LIST for pin in watch.pin_codes))}\n"
         f"👤 Notification Chat ID: {CHAT_ID} (Group/Channel)\n" # UPDATED
-        f"⚡ Concurrent Processing: Enabled (10 workers)"
+        f"⏭️ Unchanged Ticks Skipped: {MONITOR_STATS['skipped_ticks']}/{MONITOR_STATS['ticks']} "
+        f"({CATALOG_STATS['not_modified']} not modified, {CATALOG_STATS['unchanged_pages']} same-body pages, "
+        f"{CATALOG_STATS['decoded_pages']} decoded)\n"
+        f"🚦 Delivery API Rate: {DELIVERY_LIMITER.rate:.1f}/sec ({DELIVERY_LIMITER.throttled} throttled responses)\n"
+        f"🗂️ Catalog Snapshot: {catalog_snapshot_status()}\n"
+        f"🍪 Cookies: {COOKIE_SESSION.refreshes} refreshes, {COOKIE_SESSION.failures} failed, "
+        f"next in {COOKIE_SESSION.seconds_until_refresh() / 60:.0f} min\n"
+        f"🔌 Circuit Breakers: catalog {CATALOG_BREAKER.state}, delivery {DELIVERY_BREAKER.state}, detail {DETAIL_BREAKER.state}\n"
+        f"⏲️ Catalog Fetch: {format_latency(CATALOG_FETCH_SECONDS)}, {CATALOG_RETRIES.get()} retries\n"
+        f"⏲️ Delivery Check: {format_latency(DELIVERY_CHECK_SECONDS)}\n"
+        f"👕 Variants: {variant_status()}\n"
+        f"🚫 HTTP 403s: catalog {UPSTREAM_403.get('catalog')}, delivery {UPSTREAM_403.get('delivery')}, detail {UPSTREAM_403.get('detail')}\n"
+        f"📨 Notifications Sent: {sum(ALERTS_SENT.values.values())} ({ALERTS_FAILED.get()} failed), "
+        f"last monitor pass {MONITOR_PASS_SECONDS.get():.2f}s\n"
+        f"🐢 Event Loop Stalls: {LOOP_STATS['stalls']} (worst {LOOP_STATS['max_lag']:.2f}s)\n"
+        f"🗄️ Delivery Cache: {cache_stats['entries']} entries, {cache_stats['hit_rate']:.0%} hit rate "
+        f"({cache_stats['hits']} hits, {cache_stats['coalesced']} coalesced, {cache_stats['misses']} misses)\n"
+        f"💾 Delivery API Calls Saved: {cache_stats['saved_per_hour']:.0f}/hour\n"
+        f"⚡ Concurrent Processing: Enabled ({HTTP_MAX_CONNECTIONS_PER_HOST} pooled connections, HTTP/2: {'on' if HTTP2_AVAILABLE else 'off'})\n"
+        f"📈 Metrics: {f'http://{METRICS_HOST}:{METRICS_PORT}/metrics' if METRICS_SERVER is not None else 'endpoint off'}"
     )
 
+# /reset categories (short names and the ledger kinds themselves)
+RESET_KINDS = {
+    'new': NOTIFIED_NEW_PRODUCT, NOTIFIED_NEW_PRODUCT: NOTIFIED_NEW_PRODUCT,
+    'oos': NOTIFIED_OUT_OF_STOCK, NOTIFIED_OUT_OF_STOCK: NOTIFIED_OUT_OF_STOCK,
+    'price': NOTIFIED_PRICE_CHANGE, NOTIFIED_PRICE_CHANGE: NOTIFIED_PRICE_CHANGE,
+    'restock': NOTIFIED_RESTOCK,
+}
+
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Reset notification tracking files."""
+    """Reset notification tracking: everything, one category (new/oos/restock/price) and/or one product code."""
     try:
-        # Clear notification tracking files
-        if os.path.exists(NOTIFIED_OUT_OF_STOCK_FILE):
-            os.remove(NOTIFIED_OUT_OF_STOCK_FILE)
-        if os.path.exists(NOTIFIED_NEW_PRODUCTS_FILE):
-            os.remove(NOTIFIED_NEW_PRODUCTS_FILE)
-        if os.path.exists(NOTIFIED_PRICE_CHANGES_FILE):
-            os.remove(NOTIFIED_PRICE_CHANGES_FILE)
+        args = list(context.args or [])
+        kinds = [RESET_KINDS[args.pop(0).lower()]] if args and args[0].lower() in RESET_KINDS else None
+        codes = args[:1] or None
+        if len(args) > 1:
+            await update.message.reply_text("❌ Usage: /reset [new|oos|restock|price] [product code]")
+            return
+        
+        # Clear the matching part of the notification ledger
+        removed = await NOTIFICATION_LEDGER.clear(kinds, codes)
         
+        scope = ' '.join(filter(None, [kinds and kinds[0].replace('_', ' '), codes and codes[0]])) or 'all'
         await update.message.reply_text(
-            "✅ <b>Notification tracking reset!</b>\n\n"
-            "You will now receive notifications again for products that were previously notified."
+            f"✅ <b>Notification tracking reset!</b> ({scope}, {removed} entries)\n\n"
+            "You will now receive notifications again for products that were previously notified.",
+            parse_mode='HTML'
         )
     except Exception as e:
         await update.message.reply_text(f"❌ Error resetting notification tracking: {str(e)}")
@@ -806,7 +3481,7 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # --- COMMANDS THAT WERE NOT MODIFIED ---
 async def check_single_product_delivery(product, index, total):
     """Check delivery for a single product (used by /products)"""
-    code = product.get('code')
+    code = product.code
     if not code:
         return None
     
@@ -825,67 +3500,103 @@ async def check_single_product_delivery(product, index, total):
     return None
 
 async def products_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send all products one by one with images and delivery info (for MONITOR_PIN_CODES)."""
-    # This remains largely the same, checking MONITOR_PIN_CODES
-    progress_message = await update.message.reply_text(f"📦 Fetching all products and checking delivery for {', '.join(MONITOR_PIN_CODES)}...")
+    """Send all products of the default watch one by one with images and delivery info (for its pin codes)."""
+    pin_codes = DEFAULT_WATCH.pin_codes
+    progress_message = await update.message.reply_text(f"📦 Fetching all products and checking delivery for {', '.join(pin_codes)}...")
     
-    catalog_data = fetch_catalog()
-    if not catalog_data:
-        await progress_message.edit_text("❌ Failed to fetch products. Please try again later.\n\nIf this error persists, the cookies may have expired. Please update them in the script.")
+    # Reuse the monitor's latest sweep when it is recent enough
+    snapshot = await CATALOG_SNAPSHOTS[DEFAULT_WATCH.name].get()
+    if not snapshot:
+        await progress_message.edit_text(catalog_unavailable_message())
         return
     
-    products = catalog_data.get('products', [])
+    products = snapshot.products
     if not products:
         await progress_message.edit_text("❌ No products found.")
         return
     
-    # Store products in cache with indices
-    global PRODUCTS_CACHE
-    PRODUCTS_CACHE = {str(i+1): product for i, product in enumerate(products)}
+    # Remember the numbering for /checkdelivery (the snapshot tuple is shared, not copied)
+    chat_id = update.effective_chat.id
+    RESULT_SESSIONS.start(chat_id, effective_user_id(update), products, pin_codes)
     
     await progress_message.edit_text(f"📤 Sending {len(products)} products...")
     
+    matrix = await check_delivery_matrix([product.code for product in products], pin_codes)
+    last_edit_at = time.time()
     for i, product in enumerate(products):
-        delivery_info = await check_delivery_for_all_pins(product.get('code'))
-        message, image_url = format_product_info(product, index=i, delivery_info=delivery_info)
-        
         try:
-            if image_url:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=image_url,
-                    caption=message,
-                    parse_mode='HTML'
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=message,
-                    parse_mode='HTML'
-                )
+            message, image_url = format_product_info(product, index=i, delivery_info=matrix.row(product.code))
+            await enqueue_notification(chat_id, message, image_url)
             
-            await asyncio.sleep(0.3)
-            
-            if (i + 1) % 5 == 0:
+            # Update progress at a fixed interval
+            now = time.time()
+            if now - last_edit_at >= PROGRESS_EDIT_INTERVAL and i + 1 < len(products):
+                last_edit_at = now
                 await progress_message.edit_text(
                     f"📤 Sending {len(products)} products...\n"
-                    f"✅ Sent: {i + 1}/{len(products)}"
+                    f"✅ Queued: {i + 1}/{len(products)}"
                 )
         except Exception as e:
-            logger.error(f"Error sending product {product.get('code')}: {e}")
+            logger.error(f"Error sending product {product.code}: {e}")
     
-    await progress_message.edit_text(f"✅ All {len(products)} products sent! Use /checkdelivery <number> to check delivery again.")
+    await progress_message.edit_text(f"✅ All {len(products)} products queued for sending! Use /checkdelivery <number> to check delivery again.")
 
 
 async def post_init(application: Application) -> None:
     """Post-initialization function to start monitoring."""
-    # Start the real-time monitoring task
+    global NOTIFICATION_DISPATCHER
+    # Initialize product codes file
+    existing_codes = await run_db(load_product_codes)
+    if not existing_codes:
+        snapshots = await asyncio.gather(*(CATALOG_SNAPSHOTS[watch.name].refresh() for watch in WATCH_LIST))
+        if all(snapshots):
+            products, _ = merge_watch_snapshots(snapshots)
+            codes = set(product.code for product in products)
+            await run_db(save_product_codes, codes)
+            
+            for product in products:
+                PREVIOUS_CATALOG[product.code] = product
+            await run_db(save_product_details, PREVIOUS_CATALOG)
+    
+    # Start the notification dispatcher (also sends anything left in the outbox from the last run)
+    NOTIFICATION_DISPATCHER = NotificationDispatcher(application.bot)
+    application.create_task(NOTIFICATION_DISPATCHER.run())
+    
+    # Start the real-time monitoring task and the scheduler that sweeps the watches for it
     application.create_task(monitor_catalog_changes(application))
+    application.create_task(WATCH_SCHEDULER.run())
+    
+    # Resolve size/color availability of tracked products in the background
+    application.create_task(VARIANT_TRACKER.run())
+    
+    # Expose metrics for scraping
+    await start_metrics_server()
+    
+    # Keep the notification ledger bounded
+    application.create_task(NOTIFICATION_LEDGER.run())
+    
+    # Keep the shared cookies fresh
+    application.create_task(COOKIE_SESSION.run())
+    
+    # Watch for handlers or tasks blocking the event loop
+    application.create_task(watch_event_loop())
+
+async def post_shutdown(application: Application) -> None:
+    """Release pooled HTTP connections and the state database when the bot stops."""
+    for task in PRODUCT_ALERT_TASKS:
+        task.cancel()
+    await asyncio.gather(*PRODUCT_ALERT_TASKS, return_exceptions=True)
+    await VARIANT_TRACKER.stop()
+    await close_http_client()
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.close()
+    await run_db(close_state_db)
+    BLOCKING_EXECUTOR.shutdown(wait=False)
 
 def main() -> None:
     """Start the bot."""
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -896,21 +3607,6 @@ def main() -> None:
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("reset", reset_command))
     
-    # Initialize product codes file
-    existing_codes = load_product_codes()
-    if not existing_codes:
-        catalog_data = fetch_catalog()
-        if catalog_data:
-            products = catalog_data.get('products', [])
-            codes = set(product.get('code') for product in products if product.get('code'))
-            save_product_codes(codes)
-            
-            for product in products:
-                code = product.get('code')
-                if code:
-                    PREVIOUS_CATALOG[code] = product
-            save_product_details(PREVIOUS_CATALOG)
-    
     # Run the bot until you press Ctrl-C
     application.run_polling()
 